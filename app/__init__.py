@@ -1,16 +1,18 @@
 import os
 
 from flask import Flask, request
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
+from app.cache import TTLCache
+from app.replicas import RoutingSQLAlchemy
 
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 
 login = LoginManager()
@@ -21,6 +23,9 @@ mail = Mail()
 
 bootstrap = Bootstrap()
 
+# Cache of API tokens to user's data.
+token_cache = TTLCache()
+
 
 # Application Factory.
 def create_app(config_class=Config):
@@ -28,13 +33,41 @@ def create_app(config_class=Config):
 	# App configs.
 	app = Flask(__name__)
 	app.config.from_object(config_class)
+	if app.config['PROXY_FIX_X_FOR']:
+		# Client addresses and schemes are taken from headers of the proxies.
+		app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'],
+								x_proto=app.config['PROXY_FIX_X_FOR'])
 
 	# Initialize extensions.
 	db.init_app(app)
+	from app.replicas import replica_routing
+	replica_routing.init_app(app)
+	from app.database import engine_profile
+	engine_profile.init_app(app)
 	migrate.init_app(app, db)
 	login.init_app(app)
 	mail.init_app(app)
 	bootstrap.init_app(app)
+	token_cache.configure(app.config['TOKEN_CACHE_SIZE'],
+						  app.config['TOKEN_CACHE_TTL'])
+
+	from app.email import dispatcher as mail_dispatcher
+	mail_dispatcher.init_app(app)
+
+	from app.reference import reference
+	reference.init_app(app)
+
+	from app.sqlstats import sql_stats
+	sql_stats.init_app(app)
+
+	from app.metrics import metrics
+	metrics.init_app(app)
+
+	from app.fragments import fragment_cache
+	fragment_cache.init_app(app)
+
+	from app.ratelimit import rate_limiter
+	rate_limiter.init_app(app)
 
 	# Blueprints registration.
 	from app.auth import bp as auth_bp
@@ -1,10 +1,12 @@
 from datetime import datetime
 from wtforms import StringField, SelectField, PasswordField, SubmitField, \
 	IntegerField
+from wtforms.widgets import HiddenInput
 from wtforms.validators import DataRequired, NumberRange, ValidationError, \
 	EqualTo, Email, Regexp, Length
 from flask_wtf import FlaskForm
 from app.models import User, Language, Car, Role
+from app.reference import reference
 
 
 class UserForm(FlaskForm):
@@ -73,17 +75,19 @@ class EditUserProfileForm(FlaskForm):
 
 
 class UserAddCarForm(FlaskForm):
-	car = SelectField('Car', coerce=int, validators=[DataRequired()])
+	# Car id is set by the search field on the page.
+	car = IntegerField('Car', widget=HiddenInput(), validators=[DataRequired('Please select a car.')])
 	submit = SubmitField('Add Car')
 
-	def __init__(self, user_cars, *args, **kwargs):
+	def __init__(self, user, *args, **kwargs):
 		super(UserAddCarForm, self).__init__(*args, **kwargs)
-		user_cars = [(car.id, car.get_name()) for car in user_cars]
-		choices = Car.choices()
-		for car in user_cars:
-			if car in choices:
-				choices.remove(car)
-		self.car.choices = choices
+		self.user = user
+
+	def validate_car(self, car):
+		if Car.query.get(car.data) is None:
+			raise ValidationError('Please select a car.')
+		if self.user.cars.filter(Car.id == car.data).count():
+			raise ValidationError('The user already has this car.')
 
 
 class CarForm(FlaskForm):
@@ -94,7 +98,7 @@ class CarForm(FlaskForm):
 		if cls.fields_added:
 			return
 		# Add dynamic fields.
-		langs = Language.query.all()
+		langs = reference.languages()
 		for lang in langs:
 			if lang.code == 'en':
 				setattr(cls, lang.code, StringField(f'{lang.name} name', validators=[DataRequired()]))
@@ -1,8 +1,11 @@
-from flask import render_template, request, url_for, flash, redirect, current_app
+from flask import render_template, request, url_for, flash, redirect, current_app, \
+	jsonify
 from flask_login import current_user, login_required
 from app import db
 from app.decorators import admin_required
-from app.models import User, Car, Language, CarLanguage
+from app.models import User, Car, CarLanguage
+from app.reference import reference
+from app import search
 from .forms import UserForm, EditUserProfileForm, UserAddCarForm, CarForm
 from .email import send_notice_user_about_car_email
 from . import bp
@@ -35,12 +38,12 @@ def user(id):
 	page = request.args.get('page', 1, type=int)
 	cars = user.cars.order_by(Car.timestamp.desc()).paginate(
 		page, current_app.config['POSTS_PER_PAGE'], False)
-	next_url = url_for('.user', page=cars.next_num) \
+	next_url = url_for('.user', id=user.id, page=cars.next_num) \
 		if cars.has_next else None
-	prev_url = url_for('.user', page=cars.prev_num) \
+	prev_url = url_for('.user', id=user.id, page=cars.prev_num) \
 		if cars.has_prev else None
 	# Add selected car to user.
-	form = UserAddCarForm(user_cars=user.cars.all())
+	form = UserAddCarForm(user=user)
 	if form.validate_on_submit():
 		car = Car.query.get(form.car.data)
 		user.cars.append(car)
@@ -57,8 +60,6 @@ def user(id):
 			db.session.commit()
 			send_notice_user_about_car_email(user=user, about='remove')
 			return redirect(url_for('.user', id=user.id))
-	if not form.car.choices:
-		form = None
 	return render_template('admin/user.html', title='User\'s Profile', 
 				user=user, form=form, cars=cars.items, total_cars=cars.total,
 				next_url=next_url, prev_url=prev_url) 
@@ -141,6 +142,12 @@ def delete_user(id):
 @login_required
 @admin_required
 def cars():
+	q = request.args.get('q', '').strip()
+	if q:
+		# Ranked search results fit on one page.
+		cars = search.search_cars(q, current_app.config['SEARCH_RESULTS_LIMIT'])
+		return render_template('admin/cars.html', title='Cars', cars=cars,
+							   total=len(cars), q=q)
 	page = request.args.get('page', 1, type=int)
 	cars = Car.query.order_by(Car.timestamp.desc()).paginate(
 		page, current_app.config['POSTS_PER_PAGE'], False)
@@ -152,6 +159,22 @@ def cars():
 						   total=cars.total, next_url=next_url, prev_url=prev_url)
 
 
+# Search cars by name for the car picker, as JSON.
+@bp.route('/cars/search')
+@login_required
+@admin_required
+def search_cars():
+	prefix = request.args.get('q', '').strip()
+	limit = min(request.args.get('limit', 20, type=int), 100)
+	user_id = request.args.get('user_id', type=int)
+	user = User.query.get_or_404(user_id) if user_id else None
+	cars = Car.search_by_name(prefix, exclude_user=user, limit=limit)
+	lang_code = current_user.get_language().code
+	Car.load_names(cars, lang_code)
+	return jsonify({'items': [{'id': car.id, 'name': car.get_name(lang_code)}
+							  for car in cars]})
+
+
 @bp.route('/cars/create', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -161,11 +184,11 @@ def create_car():
 	if form.validate_on_submit():
 		car = Car()
 		# Сколько языков заполнено столько и создаем
-		langs = Language.query.all()
+		langs = reference.languages()
 		for key in form.data:
 			if key in [lang.code for lang in langs]:
 				lang = [lang for lang in langs if lang.code == key]
-				car.names.append(CarLanguage(name=form.data[key], language=lang[0]))
+				car.names.append(CarLanguage(name=form.data[key], language_id=lang[0].id))
 		car.year = int(form.year.data)
 		db.session.add(car)
 		db.session.commit()
@@ -182,7 +205,7 @@ def edit_car(id):
 	car = Car.query.get_or_404(id)
 	CarForm.add_fields()
 	form = CarForm()
-	langs = Language.query.all()
+	langs = reference.languages()
 	lang_codes = [lang.code for lang in langs]
 
 	if form.validate_on_submit():
@@ -202,7 +225,8 @@ def edit_car(id):
 		
 		new_lang_code = set(lang_codes) - set(car_lang_codes)
 		for new_code in new_lang_code:
-			car.names.append(CarLanguage(name=form[new_code].data), language=new_code)
+			lang = reference.language_by_code(new_code)
+			car.names.append(CarLanguage(name=form[new_code].data, language_id=lang.id))
 
 		car.year = int(form.year.data)
 		db.session.add(car)
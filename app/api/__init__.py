@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('api', __name__)
 
-from . import users, cars, errors, tokens
\ No newline at end of file
+from . import users, cars, export, changes, errors, tokens
\ No newline at end of file
@@ -1,6 +1,8 @@
 from flask import g
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
+from app import db
 from app.models import User
+from app.metrics import metrics
 from app.api.errors import error_response
 
 
@@ -11,9 +13,16 @@ token_auth = HTTPTokenAuth()
 def verify_password(username, password):
 	user = User.query.filter_by(username=username).first()
 	if user is None:
+		metrics.auth_attempts.inc(method='basic', outcome='unknown_user')
 		return False
 	g.current_user = user
-	return user.check_password(password)
+	if not user.check_password(password):
+		metrics.auth_attempts.inc(method='basic', outcome='wrong_password')
+		return False
+	metrics.auth_attempts.inc(method='basic', outcome='valid')
+	if user.upgrade_password(password):
+		db.session.commit()
+	return True
 
 @basic_auth.error_handler
 def basic_auth_error():
@@ -22,6 +31,8 @@ def basic_auth_error():
 
 @token_auth.verify_token
 def verify_token(token):
+	if not token:
+		metrics.auth_attempts.inc(method='token', outcome='missing')
 	g.current_user = User.check_token(token) if token else None
 	return g.current_user is not None
 
@@ -1,6 +1,10 @@
-from flask import jsonify, request
+from datetime import datetime
+from flask import jsonify, request, g
 from app.models import Car
+from app.search import search_cars
 from .auth import token_auth
+from .errors import bad_request
+from .etags import make_etag, conditional_response
 from . import bp
 
 
@@ -8,4 +12,78 @@ from . import bp
 @bp.route('/cars/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_car(id):
-	return jsonify(Car.query.get_or_404(id).to_dict())
\ No newline at end of file
+	car = Car.query.get_or_404(id)
+	try:
+		fields = Car.parse_fields(request.args.get('fields'))
+	except ValueError as e:
+		return bad_request(str(e))
+	etag = make_etag('car', car.id, car.version, request.args.get('fields'))
+	return conditional_response(etag, lambda: car.to_dict(fields=fields))
+
+
+# Get cars filtered by year range, name prefix and timestamp window.
+@bp.route('/cars', methods=['GET'])
+@token_auth.login_required
+def get_cars():
+	page = request.args.get('page', 1, type=int)
+	per_page = max(1, min(request.args.get('per_page', 10, type=int), 100))
+	cursor = request.args.get('cursor')
+	with_total = request.args.get('total', 0, type=int) == 1
+	# Filters as given, to build the links.
+	filters = {}
+	for field in ('year_from', 'year_to', 'name', 'since', 'until'):
+		if request.args.get(field):
+			filters[field] = request.args[field]
+	for field in ('year_from', 'year_to'):
+		if field in filters and not (filters[field].isdigit() and len(filters[field]) == 4):
+			return bad_request('{} must be a year like 1999'.format(field))
+	timestamps = {}
+	for field in ('since', 'until'):
+		if field in filters:
+			timestamps[field] = parse_timestamp(filters[field])
+			if timestamps[field] is None:
+				return bad_request('{} must be a date like 2019-12-31 '
+								   'or 2019-12-31T23:59:59'.format(field))
+	lang_code = g.current_user.get_language().code
+	query = Car.catalog(year_from=filters.get('year_from'),
+						year_to=filters.get('year_to'),
+						name=filters.get('name'), lang_code=lang_code,
+						since=timestamps.get('since'), until=timestamps.get('until'))
+	try:
+		fields = Car.parse_fields(request.args.get('fields'))
+		data = Car.to_collection_dict(query, page, per_page,
+									  'api.get_cars', cursor=cursor,
+									  with_total=with_total, fields=fields,
+									  lang_code=lang_code, **filters)
+	except ValueError as e:
+		return bad_request(str(e))
+	return jsonify(data)
+
+
+# Full-text search by car names in any language, best matches first.
+@bp.route('/cars/search', methods=['GET'])
+@token_auth.login_required
+def search():
+	text = request.args.get('q', '').strip()
+	if not text:
+		return bad_request('must include q field')
+	limit = min(request.args.get('limit', 20, type=int), 100)
+	try:
+		fields = Car.parse_fields(request.args.get('fields'))
+	except ValueError as e:
+		return bad_request(str(e))
+	lang_code = g.current_user.get_language().code
+	cars = search_cars(text, limit)
+	return jsonify({
+		'items': Car.items_to_dict(cars, fields=fields, lang_code=lang_code),
+		'meta': {'q': text, 'limit': limit, 'count': len(cars)}
+	})
+
+
+def parse_timestamp(value):
+	for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+		try:
+			return datetime.strptime(value, fmt)
+		except ValueError:
+			pass
+	return None
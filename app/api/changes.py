@@ -0,0 +1,20 @@
+from flask import current_app, jsonify, request, g
+from app.models import Change
+from .auth import token_auth
+from .decorators import admin_required
+from .errors import bad_request
+from . import bp
+
+
+# Changed users, cars and user's cars after the since cursor, for sync jobs.
+@bp.route('/changes', methods=['GET'])
+@token_auth.login_required
+@admin_required
+def get_changes():
+	since = request.args.get('since', 0, type=int)
+	limit = min(request.args.get('limit', 100, type=int), 1000)
+	if since < 0 or limit < 1:
+		return bad_request('since must not be negative and limit must be positive')
+	lang_code = request.args.get('lang_code') or g.current_user.get_language().code
+	return jsonify(Change.to_feed_dict(since, limit, lang_code,
+									   current_app.config['CHANGE_FEED_LAG']))
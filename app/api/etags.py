@@ -0,0 +1,19 @@
+from hashlib import md5
+from flask import request, jsonify, make_response
+
+
+def make_etag(*parts):
+	return md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def conditional_response(etag, build):
+	"""
+	Return 304 Not Modified if the client has the etag,
+	otherwise jsonify the dict returned by build().
+	:param build: callable, it's not called for 304 responses
+	"""
+	if etag in request.if_none_match:
+		response = make_response('', 304)
+	else:
+		response = jsonify(build())
+	response.set_etag(etag)
+	return response
@@ -0,0 +1,23 @@
+from flask import Response, request, g, stream_with_context
+from app.export import export, MIMETYPES
+from .auth import token_auth
+from .decorators import admin_required
+from .errors import bad_request
+from . import bp
+
+
+# Stream all users, cars or user-car links as NDJSON or CSV.
+@bp.route('/export/<kind>', methods=['GET'])
+@token_auth.login_required
+@admin_required
+def export_rows(kind):
+	format = request.args.get('format', 'ndjson')
+	lang_code = request.args.get('lang_code') or g.current_user.get_language().code
+	try:
+		chunks = export(kind, format, lang_code)
+	except ValueError as e:
+		return bad_request(str(e))
+	response = Response(stream_with_context(chunks), mimetype=MIMETYPES[format])
+	response.headers['Content-Disposition'] = \
+		'attachment; filename={}.{}'.format(kind, format)
+	return response
@@ -1,9 +1,11 @@
 from flask import jsonify, request, url_for, g, abort
 from app import db
-from app.models import User
+from app.models import User, Car, usercar_table
+from app.admin.email import send_notice_user_about_car_email
 from .auth import token_auth
 from .decorators import admin_required
 from .errors import bad_request
+from .etags import make_etag, conditional_response
 from . import bp
 
 
@@ -13,7 +15,13 @@ from . import bp
 def get_user(id):
 	if g.current_user.id != id and not g.current_user.is_administrator():
 		abort(403)
-	return jsonify(User.query.get_or_404(id).to_dict())
+	user = User.query.get_or_404(id)
+	try:
+		fields = User.parse_fields(request.args.get('fields'))
+	except ValueError as e:
+		return bad_request(str(e))
+	etag = make_etag('user', user.id, user.version, request.args.get('fields'))
+	return conditional_response(etag, lambda: user.to_dict(fields=fields))
 
 # Get all users data.
 @bp.route('/users', methods=['GET'])
@@ -21,9 +29,17 @@ def get_user(id):
 @admin_required
 def get_users():
 	page = request.args.get('page', 1, type=int)
-	per_page = min(request.args.get('per_page', 10, type=int), 100)
-	data = User.to_collection_dict(query=User.query, page=page,
-			per_page=per_page, endpoint='api.get_users')
+	per_page = max(1, min(request.args.get('per_page', 10, type=int), 100))
+	# Opt-in keyset pagination: ?cursor= for the first page.
+	cursor = request.args.get('cursor')
+	with_total = request.args.get('total', 0, type=int) == 1
+	try:
+		fields = User.parse_fields(request.args.get('fields'))
+		data = User.to_collection_dict(query=User.query, page=page,
+				per_page=per_page, endpoint='api.get_users', cursor=cursor,
+				with_total=with_total, fields=fields)
+	except ValueError as e:
+		return bad_request(str(e))
 	return jsonify(data)
 
 
@@ -34,14 +50,88 @@ def get_user_cars(id):
 		abort(403)
 	user = User.query.get_or_404(id)
 	page = request.args.get('page', 1, type=int)
-	per_page = min(request.args.get('per_page', 10, type=int), 100)
-	data = User.to_collection_dict(query=user.cars, page=page, per_page=per_page,
-								   endpoint='api.get_user_cars', id=id, lang_code=g.current_user.language.code)
-	return jsonify(data)
+	per_page = max(1, min(request.args.get('per_page', 10, type=int), 100))
+	cursor = request.args.get('cursor')
+	with_total = request.args.get('total', 0, type=int) == 1
+	lang_code = g.current_user.get_language().code
+	try:
+		User.decode_cursor(cursor)
+		fields = Car.parse_fields(request.args.get('fields'))
+	except ValueError as e:
+		return bad_request(str(e))
+	etag = make_etag('user-cars', user.id, user.version, user.get_cars_version(),
+					 lang_code, request.query_string.decode('utf-8'))
+	# Order the cursor pages on usercar's primary key (user_id, car_id).
+	return conditional_response(etag, lambda: User.to_collection_dict(
+		query=user.cars, page=page, per_page=per_page,
+		endpoint='api.get_user_cars', cursor=cursor, key=usercar_table.c.car_id,
+		with_total=with_total, fields=fields, id=id, lang_code=lang_code))
+
+
+# Read a list of car ids from the request's JSON.
+def get_car_ids():
+	data = request.get_json(silent=True) or {}
+	car_ids = data.get('car_ids')
+	if not isinstance(car_ids, list) or not car_ids or \
+			not all(isinstance(car_id, int) and not isinstance(car_id, bool)
+					for car_id in car_ids):
+		return None
+	return car_ids
+
+
+# Add many cars to the user.
+@bp.route('/users/<int:id>/cars', methods=['POST'])
+@token_auth.login_required
+@admin_required
+def add_user_cars(id):
+	user = User.query.get_or_404(id)
+	car_ids = get_car_ids()
+	if car_ids is None or len(car_ids) > 1000:
+		return bad_request('must include car_ids, a list of up to 1000 car ids')
+	found = {car_id for car_id, in
+			 db.session.query(Car.id).filter(Car.id.in_(set(car_ids)))}
+	missing = sorted(set(car_ids) - found)
+	if missing:
+		return bad_request('cars not found: {}'.format(
+			', '.join(str(car_id) for car_id in missing)))
+	added = user.add_cars(car_ids)
+	db.session.commit()
+	if added:
+		send_notice_user_about_car_email(user=user, about='add',
+			cars=user_cars(user, added))
+	return jsonify({'added': added, 'car_count': user.car_count})
+
+
+# Remove many cars from the user.
+@bp.route('/users/<int:id>/cars', methods=['DELETE'])
+@token_auth.login_required
+@admin_required
+def remove_user_cars(id):
+	user = User.query.get_or_404(id)
+	car_ids = get_car_ids()
+	if car_ids is None or len(car_ids) > 1000:
+		return bad_request('must include car_ids, a list of up to 1000 car ids')
+	removed = user.remove_cars(car_ids)
+	cars = user_cars(user, removed)
+	db.session.commit()
+	if removed:
+		send_notice_user_about_car_email(user=user, about='remove', cars=cars)
+	return jsonify({'removed': removed, 'car_count': user.car_count})
+
+
+def user_cars(user, car_ids):
+	# Cars with names in the user's language, for the notice email.
+	cars = Car.query.filter(Car.id.in_(car_ids)).order_by(Car.id).all()
+	Car.load_names(cars, user.get_language().code)
+	return cars
 
 
 @bp.route('/users', methods=['POST'])
 def create_user():
+	try:
+		fields = User.parse_fields(request.args.get('fields'))
+	except ValueError as e:
+		return bad_request(str(e))
 	data = request.get_json() or {}
 	required = ('username', 'email', 'password', 'language_code')
 	for field in required:
@@ -55,7 +145,7 @@ def create_user():
 	user.from_dict(data, new_user=True)
 	db.session.add(user)
 	db.session.commit()
-	response = jsonify(user.to_dict())
+	response = jsonify(user.to_dict(fields=fields))
 	response.status_code = 201
 	response.headers['Location'] = url_for('api.get_user', id=user.id)
 	return response
@@ -68,6 +158,10 @@ def update_user(id):
 	if g.current_user.id != id and not g.current_user.is_administrator():
 		abort(403)
 	user = User.query.get_or_404(id)
+	try:
+		fields = User.parse_fields(request.args.get('fields'))
+	except ValueError as e:
+		return bad_request(str(e))
 	data = request.get_json() or {}
 	if 'username' in data and data['username'] != user.username and \
 			User.query.filter_by(username=data['username']).first():
@@ -77,4 +171,4 @@ def update_user(id):
 		return bad_request('please use a different email address')
 	user.from_dict(data, new_user=False)
 	db.session.commit()
-	return jsonify(user.to_dict())
\ No newline at end of file
+	return jsonify(user.to_dict(fields=fields))
\ No newline at end of file
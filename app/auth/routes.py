@@ -19,6 +19,8 @@ def login():
 		if user is None or not user.check_password(form.password.data):
 			flash('Invalid username or password')
 			return redirect(url_for('.login'))
+		if user.upgrade_password(form.password.data):
+			db.session.commit()
 		login_user(user, remember=form.remember_me.data)
 		next_page = request.args.get('next')
 		# For secure we check if the next_page is relative or not.
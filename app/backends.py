@@ -0,0 +1,25 @@
+import importlib
+
+
+def load_backend(name, backends, setting):
+	"""
+	Return a backend class by its name or 'module:Class' path.
+	:param backends: {name: class} of the built-in backends
+	:param setting: config key of the name, used in errors
+	"""
+	if name in backends:
+		return backends[name]
+	module, _, attr = name.partition(':')
+	try:
+		return getattr(importlib.import_module(module), attr)
+	except (ImportError, AttributeError, ValueError):
+		raise RuntimeError('Unknown {} {}'.format(setting, name))
+
+
+def redis_client(url, setting):
+	"""Return a Redis client, the redis package is only needed when it's used."""
+	try:
+		import redis
+	except ImportError:
+		raise RuntimeError('{} needs the redis package'.format(setting))
+	return redis.Redis.from_url(url)
@@ -0,0 +1,393 @@
+import base64
+import hashlib
+import http.client
+import logging
+import multiprocessing
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from urllib.parse import urlsplit
+from flask import current_app, url_for
+from sqlalchemy import create_engine, exc
+from sqlalchemy.schema import CreateTable
+from werkzeug.serving import BaseWSGIServer
+from app import db
+from app.database import engine_options, set_pragmas
+from app.models import User, Car, Role, Language, Permission
+
+
+# Password of the administrator in benchmark databases.
+BENCH_PASSWORD = 'bench'
+
+
+def bench_objects():
+	"""
+	Return (admin, user, car) to request pages with: the first administrator,
+	the user with the most cars and the car with the most users.
+	"""
+	admin = User.query.join(Role).filter(Role.permissions.op('&')(Permission.ADMIN) != 0) \
+		.order_by(User.id).first()
+	user = User.query.order_by(User.car_count.desc(), User.id).first()
+	car = Car.query.order_by(Car.users_count.desc(), Car.id).first()
+	return admin, user, car
+
+def bench_pages(user, car):
+	"""
+	Return [(endpoint, url arguments)] of read-only pages and API endpoints.
+	Collections are requested with big pages to make N+1 queries visible.
+	"""
+	return [
+		('main.index', {}),
+		('main.user', {'username': user.username}),
+		('admin.users', {}),
+		('admin.user', {'id': user.id}),
+		('admin.cars', {}),
+		('admin.cars', {'q': 'a'}),
+		('admin.edit_car', {'id': car.id}),
+		('admin.search_cars', {'q': 'a'}),
+		('api.get_users', {'per_page': 100}),
+		('api.get_user', {'id': user.id}),
+		('api.get_user_cars', {'id': user.id, 'per_page': 100}),
+		('api.get_cars', {'per_page': 100}),
+		('api.get_car', {'id': car.id}),
+		('api.search', {'q': 'a', 'limit': 100})
+	]
+
+def login_client(app, user):
+	"""
+	Return a test client logged in as the user and headers with
+	the user's API token.
+	"""
+	token = user.get_token()
+	db.session.commit()
+	client = app.test_client()
+	with client.session_transaction() as session:
+		# Flask-Login before 0.5 keeps the id in user_id.
+		session['user_id'] = session['_user_id'] = str(user.id)
+		session['_fresh'] = True
+	return client, {'Authorization': 'Bearer ' + token}
+
+def api_bench_pages(admin, user, car):
+	"""
+	Return [(name, method, endpoint, url arguments)] of the hot paths
+	timed by flask bench api.
+	"""
+	return [
+		('api.get_users', 'GET', 'api.get_users', {}),
+		('api.get_user_cars', 'GET', 'api.get_user_cars', {'id': user.id}),
+		('api.get_car', 'GET', 'api.get_car', {'id': car.id}),
+		('api.get_token', 'POST', 'api.get_token', {}),
+		('admin.users', 'GET', 'admin.users', {}),
+		('admin.cars', 'GET', 'admin.cars', {}),
+		('admin.user', 'GET', 'admin.user', {'id': user.id}),
+		('main.index', 'GET', 'main.index', {})
+	]
+
+def schema_digest():
+	"""Digest of the DDL of all tables, it changes with the models."""
+	ddl = [str(CreateTable(table).compile(db.engine)) for table in db.metadata.sorted_tables]
+	return hashlib.sha1('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+def bench_database_ready(scale):
+	"""
+	Check if the database was fully seeded with the scale and the current
+	schema. A half seeded database or an old schema gives wrong numbers.
+	"""
+	try:
+		meta = dict(db.session.execute('SELECT key, value FROM bench_meta').fetchall())
+	except exc.OperationalError:
+		db.session.rollback()
+		return False
+	return meta == {'scale': str(scale), 'schema': schema_digest()}
+
+def seed_database(scale, password):
+	"""
+	Fill the database with scale users and scale cars and an administrator
+	with the password. Existing tables are dropped first. The scale and the
+	schema are saved in bench_meta when seeding is done.
+	"""
+	from app.fake import users, cars
+	db.session.execute('DROP TABLE IF EXISTS bench_meta')
+	db.session.commit()
+	db.drop_all()
+	db.create_all()
+	Role.insert_roles()
+	Language.insert_values()
+	admin = User(username='admin', email=current_app.config['ADMINS'][0],
+				 language_id=Language.query.filter_by(code='en').first().id)
+	admin.set_password(password)
+	db.session.add(admin)
+	db.session.commit()
+	users(scale - 1, seed=scale)
+	cars(scale, seed=scale)
+	db.session.execute('CREATE TABLE bench_meta (key VARCHAR(16) PRIMARY KEY, value TEXT)')
+	db.session.execute('INSERT INTO bench_meta (key, value) VALUES (:key, :value)',
+					   [{'key': 'scale', 'value': str(scale)},
+						{'key': 'schema', 'value': schema_digest()}])
+	db.session.commit()
+
+def run_bench(app, requests, password):
+	"""
+	Time every hot path with the test client.
+	Return {name: {url, requests, mean, p50, p90, p99, max in ms, queries}}.
+	"""
+	admin, user, car = bench_objects()
+	client, headers = login_client(app, admin)
+	basic = {'Authorization': 'Basic ' + base64.b64encode(
+		'{}:{}'.format(admin.username, password).encode('utf-8')).decode('utf-8')}
+	results = {}
+	for name, method, endpoint, values in api_bench_pages(admin, user, car):
+		with app.test_request_context():
+			url = url_for(endpoint, **values)
+		timings, queries = [], []
+		# The first request warms up caches and is not counted.
+		for i in range(requests + 1):
+			db.session.remove()
+			started = perf_counter()
+			response = client.open(url, method=method,
+								   headers=basic if endpoint == 'api.get_token' else headers)
+			elapsed = perf_counter() - started
+			if response.status_code != 200:
+				raise RuntimeError('{} {} returned {}'.format(
+					method, url, response.status_code))
+			if i:
+				timings.append(elapsed * 1000)
+				queries.append(int(response.headers.get('X-Query-Count', 0)))
+		timings.sort()
+		results[name] = {
+			'url': url,
+			'requests': requests,
+			'mean': sum(timings) / len(timings),
+			'p50': percentile(timings, 50),
+			'p90': percentile(timings, 90),
+			'p99': percentile(timings, 99),
+			'max': timings[-1],
+			'queries': sum(queries) / len(queries)
+		}
+	return results
+
+def percentile(values, percent):
+	"""Percentile of sorted values, with linear interpolation."""
+	if not values:
+		return 0.0
+	position = (len(values) - 1) * percent / 100
+	lower = int(position)
+	upper = min(lower + 1, len(values) - 1)
+	return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def compare_results(baseline, current, threshold=0.2):
+	"""
+	Compare two results of flask bench api.
+	Return [(scale, name, metric, baseline, current, change, regression)],
+	a regression is a p50 or p90 slower by more than threshold
+	or more queries per request.
+	:param threshold: allowed slowdown, 0.2 is 20%
+	"""
+	rows = []
+	for scale, results in sorted(current['scales'].items(), key=lambda item: int(item[0])):
+		old_results = baseline['scales'].get(scale, {})
+		for name, result in results.items():
+			old = old_results.get(name)
+			if old is None:
+				continue
+			for metric in ('p50', 'p90', 'queries'):
+				change = (result[metric] - old[metric]) / old[metric] \
+					if old[metric] else 0.0
+				if metric == 'queries':
+					regression = result[metric] > old[metric]
+				else:
+					regression = change > threshold
+				rows.append((scale, name, metric, old[metric], result[metric],
+							 change, regression))
+	return rows
+
+def engine_worker(uri, profile, seconds, write_ratio, rows, seed, results):
+	"""
+	Read and write cars as fast as possible for the given seconds,
+	in its own process like a gunicorn worker.
+	Put (reads, writes, errors, seconds) into the results queue.
+	"""
+	engine = create_engine(uri, **engine_options(uri, profile))
+	if profile.get('pragmas') and engine.dialect.name == 'sqlite':
+		set_pragmas(engine, profile['pragmas'])
+	rnd = random.Random(seed)
+	read = db.text('SELECT car.id, car.year, car_language.name FROM car '
+				   'JOIN car_language ON car_language.car_id = car.id '
+				   'WHERE car.id = :id')
+	write = db.text('UPDATE car SET year = :year, version = version + 1 '
+					'WHERE id = :id')
+	reads = writes = errors = 0
+	started = perf_counter()
+	while perf_counter() - started < seconds:
+		car_id = rnd.randint(1, rows)
+		try:
+			if rnd.random() < write_ratio:
+				with engine.begin() as conn:
+					conn.execute(write, year=str(rnd.randint(1970, 2020)), id=car_id)
+				writes += 1
+			else:
+				with engine.connect() as conn:
+					conn.execute(read, id=car_id).fetchall()
+				reads += 1
+		except exc.OperationalError:
+			# database is locked
+			errors += 1
+	results.put((reads, writes, errors, perf_counter() - started))
+	engine.dispose()
+
+def seed_engine_bench(uri, rows):
+	"""Create the schema and rows cars with a name in a fresh database."""
+	engine = create_engine(uri)
+	db.metadata.drop_all(engine)
+	db.metadata.create_all(engine)
+	engine.execute(db.metadata.tables['language'].insert(),
+				   [{'id': 1, 'name': 'English', 'code': 'en'}])
+	engine.execute(db.metadata.tables['car'].insert(),
+				   [{'id': i, 'year': '2000', 'users_count': 0, 'version': 1}
+					for i in range(1, rows + 1)])
+	engine.execute(db.metadata.tables['car_language'].insert(),
+				   [{'car_id': i, 'language_id': 1, 'name': 'Car {}'.format(i)}
+					for i in range(1, rows + 1)])
+	engine.dispose()
+
+def run_engine_bench(uri, profile, workers=4, seconds=5, write_ratio=0.2, rows=1000):
+	"""
+	Seed a database and run worker processes reading and writing it.
+	Return {reads, writes, errors per second}.
+	"""
+	seed_engine_bench(uri, rows)
+	context = multiprocessing.get_context()
+	results = context.Queue()
+	processes = [context.Process(target=engine_worker,
+								 args=(uri, profile, seconds, write_ratio, rows, i, results))
+				 for i in range(workers)]
+	for process in processes:
+		process.start()
+	totals = [results.get() for process in processes]
+	for process in processes:
+		process.join()
+	elapsed = max(result[3] for result in totals)
+	return {
+		'reads': sum(result[0] for result in totals) / elapsed,
+		'writes': sum(result[1] for result in totals) / elapsed,
+		'errors': sum(result[2] for result in totals) / elapsed
+	}
+
+class PooledWSGIServer(BaseWSGIServer):
+	"""
+	WSGI server handling requests with a fixed pool of threads, like a
+	gunicorn gthread worker. One thread works like a sync worker.
+	"""
+	request_queue_size = 1024
+
+	def __init__(self, host, port, app, threads):
+		super(PooledWSGIServer, self).__init__(host, port, app)
+		self.executor = ThreadPoolExecutor(threads)
+
+	def process_request(self, request, client_address):
+		self.executor.submit(self._process_request, request, client_address)
+
+	def _process_request(self, request, client_address):
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+
+def serve_bench(path, threads, ready, db_latency=0):
+	"""
+	Serve the app on a benchmark database in this process, as one worker
+	with the given threads. Put the port into the ready queue.
+	:param db_latency: seconds added to every query, like a round trip
+					   to a database server
+	"""
+	from app import create_app
+	logging.getLogger('werkzeug').setLevel(logging.ERROR)
+	app = create_app(bench_config(path, 'sqlite-concurrent'))
+	if db_latency:
+		with app.app_context():
+			db.event.listen(db.engine, 'before_cursor_execute',
+							lambda *args: sleep(db_latency))
+	server = PooledWSGIServer('127.0.0.1', 0, app, threads)
+	ready.put(server.server_port)
+	server.serve_forever()
+
+def read_bench_paths(user, car):
+	"""Return URLs of the API read path timed by flask bench load."""
+	return [
+		url_for('api.get_user', id=user.id),
+		url_for('api.get_users', per_page=25),
+		url_for('api.get_user_cars', id=user.id, per_page=25),
+		url_for('api.get_car', id=car.id)
+	]
+
+def load_test(base_url, paths, headers, concurrency=32, seconds=10):
+	"""
+	GET the paths in turn from concurrency client threads, a new connection
+	per request, for the given seconds.
+	Return {requests, errors, rps, p50, p99 in ms}.
+	"""
+	url = urlsplit(base_url)
+	connection_class = http.client.HTTPSConnection if url.scheme == 'https' \
+		else http.client.HTTPConnection
+	lock = threading.Lock()
+	timings = []
+	errors = 0
+	deadline = perf_counter() + seconds
+
+	def client(offset):
+		nonlocal errors
+		done, failed = [], 0
+		i = offset
+		while perf_counter() < deadline:
+			path = url.path.rstrip('/') + paths[i % len(paths)]
+			i += 1
+			started = perf_counter()
+			conn = connection_class(url.hostname, url.port, timeout=30)
+			try:
+				conn.request('GET', path, headers=headers)
+				response = conn.getresponse()
+				response.read()
+				ok = response.status == 200
+			except (OSError, http.client.HTTPException):
+				ok = False
+			finally:
+				conn.close()
+			if ok:
+				done.append((perf_counter() - started) * 1000)
+			else:
+				failed += 1
+		with lock:
+			timings.extend(done)
+			errors += failed
+
+	clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+	started = perf_counter()
+	for thread in clients:
+		thread.start()
+	for thread in clients:
+		thread.join()
+	elapsed = perf_counter() - started
+	timings.sort()
+	return {
+		'requests': len(timings),
+		'errors': errors,
+		'rps': len(timings) / elapsed,
+		'p50': percentile(timings, 50),
+		'p99': percentile(timings, 99)
+	}
+
+def bench_config(path, profile=None):
+	"""Return the app config for a benchmark database file."""
+	from config import Config
+
+	class BenchConfig(Config):
+		SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+		DATABASE_PROFILE = profile
+		SQL_TIMING_HEADERS = True
+		SQL_QUERY_BUDGET_FAIL = False
+		RATELIMIT_BACKEND = None
+
+	return BenchConfig
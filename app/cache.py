@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class TTLCache(object):
+	"""
+	Thread-safe in-process LRU cache which entries expire after ttl seconds.
+	The cache is local to a process, every worker keeps its own copy.
+	"""
+
+	def __init__(self, maxsize=1024, ttl=60):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def configure(self, maxsize, ttl):
+		with self._lock:
+			self.maxsize = maxsize
+			self.ttl = ttl
+			self._data.clear()
+
+	def get(self, key, default=None):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None:
+				self.misses += 1
+				return default
+			value, expires = entry
+			if expires <= monotonic():
+				del self._data[key]
+				self.misses += 1
+				return default
+			self._data.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def set(self, key, value, ttl=None):
+		"""
+		Store value under the key.
+		:param ttl: seconds to keep the value, can't be longer than the cache's ttl
+		"""
+		ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+		if ttl <= 0 or self.maxsize <= 0:
+			return
+		with self._lock:
+			self._data[key] = (value, monotonic() + ttl)
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def __len__(self):
+		return len(self._data)
+
+	def stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'size': len(self._data),
+			'maxsize': self.maxsize
+		}
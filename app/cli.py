@@ -1,7 +1,24 @@
 import os
+import sys
+import json
+import platform
+import multiprocessing
+import sqlite3
+from datetime import datetime
+from time import perf_counter
 import click
-from app.models import Role, Language
+from flask import url_for
+from werkzeug.security import generate_password_hash
+from app import db, create_app
+from app.models import Role, Language, User, Car
 from app.fake import users, cars
+from app.search import rebuild_index
+from app.export import export as export_rows
+from app.importer import import_cars as import_rows
+from app.bench import bench_objects, bench_pages, login_client, bench_config, \
+	seed_database, run_bench, compare_results, run_engine_bench, serve_bench, \
+	read_bench_paths, load_test, bench_database_ready, BENCH_PASSWORD
+from app.sqlstats import sql_stats
 
 
 def register(app):
@@ -19,24 +36,277 @@ def register(app):
 			Language.insert_values()
 
 	@deploy.command(help_priority=2)
-	@click.argument('count')
-	def create_users(count):
+	@click.argument('count', type=int)
+	@click.option('--batch-size', default=1000, help='Users inserted by one statement.')
+	@click.option('--seed', type=int, help='Seed to generate the same users.')
+	@click.option('--password', default='password', help='Password of every user.')
+	@click.option('--password-hash', help='Ready hash of the password, skips hashing.')
+	def create_users(count, batch_size, seed, password, password_hash):
 		"""
 		Create fake users.
 		int:param How many users should be created..
 		"""
 		with app.app_context():
-			users(count)
+			users(count, batch_size=batch_size, seed=seed, password=password,
+				  password_hash=password_hash)
 
 	@deploy.command(help_priority=3)
-	@click.argument('count')
-	def create_cars(count):
+	@click.argument('count', type=int)
+	@click.option('--batch-size', default=1000, help='Cars inserted by one statement.')
+	@click.option('--seed', type=int, help='Seed to generate the same cars.')
+	def create_cars(count, batch_size, seed):
 		"""
 		Create fake cars and add them to users.
 		int:param How many cars should be created.
 		"""
 		with app.app_context():
-			cars(count)
+			cars(count, batch_size=batch_size, seed=seed)
+
+	@deploy.command(help_priority=4)
+	def update_counters():
+		"""Recompute users' car_count and cars' users_count."""
+		with app.app_context():
+			User.update_car_counts()
+			Car.update_users_counts()
+			db.session.commit()
+
+	@deploy.command(help_priority=5)
+	def reindex():
+		"""Rebuild the car names search index."""
+		with app.app_context():
+			rebuild_index()
+
+	@deploy.command(help_priority=6)
+	@click.argument('kind', type=click.Choice(['users', 'cars', 'user_cars']))
+	@click.option('--format', 'format_', default='ndjson',
+				  type=click.Choice(['ndjson', 'csv']), help='Output format.')
+	@click.option('--lang-code', default='en', help='Language of car names.')
+	@click.option('--output', '-o', type=click.File('w', encoding='utf-8'),
+				  default='-', help='Output file, default is stdout.')
+	def export(kind, format_, lang_code, output):
+		"""Write all users, cars or user-car links as NDJSON or CSV."""
+		with app.app_context():
+			try:
+				chunks = export_rows(kind, format_, lang_code)
+			except ValueError as e:
+				raise click.BadParameter(str(e))
+			for chunk in chunks:
+				output.write(chunk)
+
+	@deploy.command('import-cars', help_priority=7)
+	@click.argument('file', type=click.File('r', encoding='utf-8'))
+	@click.option('--format', 'format_', type=click.Choice(['csv', 'ndjson']),
+				  help='Default is taken from the file extension.')
+	@click.option('--batch-size', default=1000, help='Cars written by one transaction.')
+	def import_cars(file, format_, batch_size):
+		"""Insert or update cars and names from a CSV or NDJSON file."""
+		if format_ is None:
+			format_ = 'csv' if file.name.endswith('.csv') else 'ndjson'
+		with app.app_context():
+			import_rows(file, format_, batch_size)
+
+	@app.cli.group()
+	def bench():
+		"""Measure performance of the application."""
+		pass
+
+	@bench.command()
+	@click.option('--seconds', default=3.0, help='How long to hash.')
+	@click.option('--method', help='Hash method, default is PASSWORD_HASH_METHOD.')
+	@click.option('--salt-length', type=int, help='Default is PASSWORD_SALT_LENGTH.')
+	def hash(seconds, method, salt_length):
+		"""Report password hashes per second per CPU core."""
+		method = method or app.config['PASSWORD_HASH_METHOD']
+		salt_length = salt_length or app.config['PASSWORD_SALT_LENGTH']
+		count = 0
+		start = perf_counter()
+		while perf_counter() - start < seconds:
+			generate_password_hash('benchmark-password', method=method,
+								   salt_length=salt_length)
+			count += 1
+		elapsed = perf_counter() - start
+		per_core = count / elapsed
+		cores = os.cpu_count() or 1
+		click.echo('Method: {}, salt length: {}'.format(method, salt_length))
+		click.echo('Hashes per second per core: {:.1f} ({:.1f} ms per hash)'
+				   .format(per_core, 1000 / per_core))
+		click.echo('CPU cores: {}, all cores: ~{:.0f} hashes per second'
+				   .format(cores, per_core * cores))
+
+	@bench.command()
+	@click.option('--repeat', default=3, help='Requests per page.')
+	@click.option('--limit', default=10, help='How many endpoints to report.')
+	def queries(repeat, limit):
+		"""Request every read-only page, report endpoints with most queries."""
+		admin, user, car = bench_objects()
+		if admin is None or user is None or car is None:
+			raise click.ClickException('Create an administrator, users and cars first.')
+		client, headers = login_client(app, admin)
+		sql_stats.reset()
+		for endpoint, values in bench_pages(user, car):
+			with app.test_request_context():
+				url = url_for(endpoint, **values)
+			for i in range(repeat):
+				# Every request starts with an empty session, as in a worker.
+				db.session.remove()
+				response = client.get(url, headers=headers)
+				if response.status_code != 200:
+					click.echo('{} returned {}'.format(url, response.status_code))
+		click.echo('{:<24} {:>8} {:>8} {:>8} {:>8}  {}'.format(
+			'Endpoint', 'Requests', 'Queries', 'Max', 'SQL ms', 'Most repeated'))
+		for item in sql_stats.report(limit):
+			repeated = '{1}x {0}'.format(*item['repeated'])[:60] \
+				if item['repeated'] else ''
+			click.echo('{:<24} {:>8} {:>8.1f} {:>8} {:>8.2f}  {}'.format(
+				item['endpoint'], item['requests'], item['avg_queries'],
+				item['max_queries'], item['avg_sql_time'], repeated))
+
+	@bench.command()
+	@click.option('--scale', '-s', type=int, multiple=True,
+				  help='Users and cars in the database, can be repeated. Default is 1000.')
+	@click.option('--requests', '-n', default=50, help='Timed requests per endpoint.')
+	@click.option('--output', '-o', type=click.Path(dir_okay=False),
+				  default='bench.json', help='JSON file for the results.')
+	@click.option('--data-dir', type=click.Path(file_okay=False),
+				  help='Folder of the seeded databases, default is instance/bench.')
+	def api(scale, requests, output, data_dir):
+		"""Time API and admin hot paths on seeded SQLite databases."""
+		data_dir = data_dir or os.path.join(app.instance_path, 'bench')
+		os.makedirs(data_dir, exist_ok=True)
+		results = {
+			'meta': {
+				'created': datetime.utcnow().isoformat(),
+				'python': platform.python_version(),
+				'sqlite': sqlite3.sqlite_version,
+				'password_hash_method': app.config['PASSWORD_HASH_METHOD'],
+				'requests': requests
+			},
+			'scales': {}
+		}
+		for count in scale or (1000,):
+			path = os.path.join(data_dir, 'bench-{}.db'.format(count))
+			bench_app = create_app(bench_config(path))
+			with bench_app.app_context():
+				if not bench_database_ready(count):
+					click.echo('Seeding {}...'.format(path))
+					seed_database(count, BENCH_PASSWORD)
+				scale_results = run_bench(bench_app, requests, BENCH_PASSWORD)
+			results['scales'][str(count)] = scale_results
+			click.echo('Scale {}:'.format(count))
+			click.echo('{:<20} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+				'Endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'Queries'))
+			for name, result in scale_results.items():
+				click.echo('{:<20} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} '
+						   '{max:>8.2f} {queries:>8.1f}'.format(name, **result))
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+		click.echo('Results are saved to {}'.format(output))
+
+	@bench.command()
+	@click.argument('baseline', type=click.File('r'))
+	@click.argument('current', type=click.File('r'))
+	@click.option('--threshold', default=0.2, help='Allowed slowdown, 0.2 is 20%.')
+	def compare(baseline, current, threshold):
+		"""Compare results of bench api, exit with 1 on regressions."""
+		rows = compare_results(json.load(baseline), json.load(current), threshold)
+		click.echo('{:<8} {:<20} {:<8} {:>10} {:>10} {:>8}'.format(
+			'Scale', 'Endpoint', 'Metric', 'Baseline', 'Current', 'Change'))
+		for scale, name, metric, old, new, change, regression in rows:
+			click.echo('{:<8} {:<20} {:<8} {:>10.2f} {:>10.2f} {:>+7.0%}{}'.format(
+				scale, name, metric, old, new, change, ' REGRESSION' if regression else ''))
+		regressions = sum(1 for row in rows if row[-1])
+		if regressions:
+			click.echo('{} regressions.'.format(regressions))
+			sys.exit(1)
+		click.echo('No regressions.')
+
+	@bench.command()
+	@click.option('--profile', '-p', multiple=True,
+				  help='Engine profile, can be repeated. Default is every SQLite profile.')
+	@click.option('--workers', '-w', default=4, help='Processes reading and writing.')
+	@click.option('--seconds', default=5.0, help='How long every profile runs.')
+	@click.option('--write-ratio', default=0.2, help='Share of writes, 0.2 is 20%.')
+	@click.option('--rows', default=1000, help='Cars in the database.')
+	@click.option('--database-url', help='Database of non-SQLite profiles, its tables '
+				  'are dropped. Default is a file in instance/bench for SQLite.')
+	def engine(profile, workers, seconds, write_ratio, rows, database_url):
+		"""Compare read and write throughput of engine profiles."""
+		profiles = app.config['ENGINE_PROFILES']
+		data_dir = os.path.join(app.instance_path, 'bench')
+		os.makedirs(data_dir, exist_ok=True)
+		click.echo('{:<20} {:>10} {:>10} {:>10}'.format(
+			'Profile', 'Reads/s', 'Writes/s', 'Errors/s'))
+		for name in profile or [name for name in profiles if name.startswith('sqlite')]:
+			if name not in profiles:
+				raise click.BadParameter('unknown profile {}'.format(name))
+			uri = database_url
+			if uri is None:
+				if not name.startswith('sqlite'):
+					raise click.BadParameter('{} needs --database-url'.format(name))
+				path = os.path.join(data_dir, 'engine-{}.db'.format(name))
+				# The journal mode is kept in the file.
+				for suffix in ('', '-wal', '-shm'):
+					if os.path.exists(path + suffix):
+						os.remove(path + suffix)
+				uri = 'sqlite:///' + path
+			result = run_engine_bench(uri, profiles[name], workers, seconds,
+									  write_ratio, rows)
+			click.echo('{:<20} {reads:>10.0f} {writes:>10.0f} {errors:>10.1f}'.format(
+				name, **result))
+
+
+	@bench.command()
+	@click.option('--threads', '-t', type=int, multiple=True,
+				  help='Threads of the worker, can be repeated. Default is 1 (a sync '
+				  'worker) and 8.')
+	@click.option('--concurrency', '-c', default=32, help='Clients sending requests.')
+	@click.option('--seconds', default=10.0, help='How long every worker is loaded.')
+	@click.option('--scale', '-s', default=1000, help='Users and cars in the database.')
+	@click.option('--db-latency', default=0.0,
+				  help='Milliseconds added to every query, like a network round trip.')
+	@click.option('--url', help='Load a running server instead, which uses the same '
+				  'database as this app, e.g. gunicorn -c gunicorn.conf.py carrent:app.')
+	def load(threads, concurrency, seconds, scale, db_latency, url):
+		"""Requests per second of the API read path per worker."""
+		click.echo('{:<10} {:>10} {:>8} {:>10} {:>10}'.format(
+			'Threads', 'Requests/s', 'Errors', 'p50 ms', 'p99 ms'))
+		if url:
+			admin, user, car = bench_objects()
+			client, headers = login_client(app, admin)
+			with app.test_request_context():
+				paths = read_bench_paths(user, car)
+			result = load_test(url, paths, headers, concurrency, seconds)
+			click.echo('{:<10} {rps:>10.0f} {errors:>8} {p50:>10.1f} {p99:>10.1f}'.format(
+				'-', **result))
+			return
+		data_dir = os.path.join(app.instance_path, 'bench')
+		os.makedirs(data_dir, exist_ok=True)
+		path = os.path.join(data_dir, 'bench-{}.db'.format(scale))
+		bench_app = create_app(bench_config(path))
+		with bench_app.app_context():
+			if not bench_database_ready(scale):
+				click.echo('Seeding {}...'.format(path))
+				seed_database(scale, BENCH_PASSWORD)
+			admin, user, car = bench_objects()
+			client, headers = login_client(bench_app, admin)
+			with bench_app.test_request_context():
+				paths = read_bench_paths(user, car)
+		for count in threads or (1, 8):
+			# The worker runs in its own process like a gunicorn worker.
+			context = multiprocessing.get_context()
+			ready = context.Queue()
+			worker = context.Process(target=serve_bench,
+									 args=(path, count, ready, db_latency / 1000),
+									 daemon=True)
+			worker.start()
+			try:
+				base_url = 'http://127.0.0.1:{}'.format(ready.get(timeout=60))
+				result = load_test(base_url, paths, headers, concurrency, seconds)
+			finally:
+				worker.terminate()
+				worker.join()
+			click.echo('{:<10} {rps:>10.0f} {errors:>8} {p50:>10.1f} {p99:>10.1f}'.format(
+				count, **result))
 
 
 # Override the click.Group.command() to add the ability to specify a help_priority.
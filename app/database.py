@@ -0,0 +1,76 @@
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from app import db
+from app.metrics import MeasuredQueuePool
+
+
+class EngineProfile(object):
+	"""
+	Apply the engine profile named by DATABASE_PROFILE: its engine options
+	under the explicit SQLALCHEMY_ENGINE_OPTIONS, and its SQLite pragmas on
+	every new connection.
+	"""
+
+	def init_app(self, app):
+		name = app.config['DATABASE_PROFILE'] or \
+			default_profile(app.config['SQLALCHEMY_DATABASE_URI'])
+		try:
+			profile = app.config['ENGINE_PROFILES'][name]
+		except KeyError:
+			raise RuntimeError('Unknown DATABASE_PROFILE {}, use one of: {}'.format(
+				name, ', '.join(app.config['ENGINE_PROFILES'])))
+		app.config['DATABASE_PROFILE'] = name
+		options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], profile)
+		options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+		app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+		app.extensions['engine_profile'] = name
+		pragmas = profile.get('pragmas')
+		if pragmas:
+			# Engines are created now to set the pragmas before any connection.
+			with app.app_context():
+				engines = [db.get_engine(app, bind) for bind
+						   in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())]
+			for engine in engines:
+				if engine.dialect.name == 'sqlite':
+					set_pragmas(engine, pragmas)
+
+
+engine_profile = EngineProfile()
+
+
+def default_profile(uri):
+	return 'sqlite-dev' if uri.startswith('sqlite') else 'postgres-pooled'
+
+def engine_options(uri, profile):
+	"""Return create_engine() options of the profile for the database."""
+	url = make_url(uri)
+	sqlite = url.drivername.startswith('sqlite')
+	if sqlite and url.database in (None, '', ':memory:'):
+		# An in-memory database lives in its only connection.
+		return {}
+	options = dict(profile.get('engine_options', {}))
+	# Pooled connections report checkout waits to the metrics.
+	if options.get('poolclass', None if sqlite else QueuePool) is QueuePool:
+		options['poolclass'] = MeasuredQueuePool
+	return options
+
+def set_pragmas(engine, pragmas):
+	@db.event.listens_for(engine, 'connect')
+	def connect(dbapi_connection, connection_record):
+		cursor = dbapi_connection.cursor()
+		for name, value in pragmas.items():
+			cursor.execute('PRAGMA {} = {}'.format(name, value))
+		cursor.close()
+
+def pool_stats(engine):
+	"""Return the pool class, its size and connections in and out of it."""
+	pool = engine.pool
+	stats = {'pool': type(pool).__name__}
+	for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+		method = getattr(pool, key, None)
+		stats[key] = method() if method is not None else None
+	# QueuePool counts the overflow from minus the pool size.
+	if stats['overflow'] is not None:
+		stats['overflow'] = max(stats['overflow'], 0)
+	return stats
+
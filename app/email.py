@@ -1,16 +1,225 @@
-from threading import Thread
-from flask import render_template, current_app
+import atexit
+import threading
+from queue import Queue, Full, Empty
+from smtplib import SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError
+from time import monotonic, sleep
 from flask_mail import Message
 from app import mail
+from app.metrics import metrics
 
 
-def send_async_email(app, msg):
-	with app.app_context():
-		mail.send(msg)
+# The server refused one message, the connection can send the others.
+REFUSED_ERRORS = (SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError)
+
+
+def message_error(error):
+	"""
+	Check if the error is of one message: refused by the server or a bad
+	message. Other OSErrors, SMTPException is one, are of the connection.
+	"""
+	return isinstance(error, REFUSED_ERRORS) or not isinstance(error, OSError)
+
+
+def temporary_error(error):
+	"""Check if the server refused the message with a 4xx code."""
+	if isinstance(error, SMTPRecipientsRefused):
+		codes = [code for code, response in error.recipients.values()]
+	else:
+		codes = [getattr(error, 'smtp_code', 0)]
+	return all(400 <= code < 500 for code in codes)
+
+
+class MailDispatcher(object):
+	"""
+	Send emails from a fixed pool of worker threads fed by a bounded queue.
+	A worker sends up to MAIL_BATCH_SIZE queued messages over one SMTP
+	connection. A failed connection is opened again with exponential backoff,
+	a message refused with a temporary error is retried on its own.
+	"""
+
+	def __init__(self, app=None):
+		self.app = None
+		self.queue = None
+		self._workers = []
+		self._lock = threading.Lock()
+		self._reset_stats()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.shutdown()
+		self.app = app
+		self.workers = app.config['MAIL_WORKERS']
+		self.batch_size = app.config['MAIL_BATCH_SIZE']
+		self.max_retries = app.config['MAIL_MAX_RETRIES']
+		self.retry_delay = app.config['MAIL_RETRY_DELAY']
+		self.queue_timeout = app.config['MAIL_QUEUE_TIMEOUT']
+		self.queue = Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+		self._reset_stats()
+		app.extensions['mail_dispatcher'] = self
+
+	def _reset_stats(self):
+		self.sent = 0
+		self.failed = 0
+		self.dropped = 0
+		self.retries = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+		self.total_send_time = 0.0
+
+	def _start(self):
+		# Workers are started on the first email, i.e. after gunicorn forks,
+		# dead workers are replaced.
+		with self._lock:
+			self._workers = [worker for worker in self._workers if worker.is_alive()]
+			for i in range(len(self._workers), self.workers):
+				worker = threading.Thread(target=self._run,
+										  name='mail-worker-{}'.format(i))
+				worker.daemon = True
+				worker.start()
+				self._workers.append(worker)
+
+	def submit(self, msg):
+		"""
+		Put the message into the queue.
+		Return False if the queue stays full for MAIL_QUEUE_TIMEOUT seconds.
+		"""
+		self._start()
+		try:
+			self.queue.put((msg, monotonic()), timeout=self.queue_timeout)
+		except Full:
+			self.dropped += 1
+			self.app.logger.error('Mail queue is full, drop email to %s',
+								  msg.recipients)
+			return False
+		return True
+
+	def flush(self):
+		"""Block until every queued email is sent or given up."""
+		if self._workers:
+			self._start()
+			self.queue.join()
+
+	def shutdown(self, timeout=30):
+		"""Send the queued emails and stop the workers."""
+		with self._lock:
+			workers, self._workers = self._workers, []
+		for worker in workers:
+			self.queue.put(None)
+		for worker in workers:
+			worker.join(timeout)
+
+	def stats(self):
+		sent = self.sent
+		return {
+			'queue_depth': self.queue.qsize() if self.queue else 0,
+			'workers': len(self._workers),
+			'sent': sent,
+			'failed': self.failed,
+			'dropped': self.dropped,
+			'retries': self.retries,
+			# Seconds from queueing an email till it was sent.
+			'avg_latency': self.total_latency / sent if sent else 0.0,
+			'max_latency': self.max_latency,
+			# Seconds spent in SMTP sending one email.
+			'avg_send_time': self.total_send_time / sent if sent else 0.0
+		}
+
+	def _run(self):
+		stop = False
+		while not stop:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				return
+			batch, stop = self._drain([item])
+			pending = list(batch)
+			try:
+				with self.app.app_context():
+					self._send_batch(pending)
+			except Exception:
+				with self._lock:
+					self.failed += len(pending)
+				self.app.logger.exception('Sending %d emails failed', len(pending))
+			finally:
+				for i in range(len(batch)):
+					self.queue.task_done()
+
+	def _drain(self, batch):
+		# Take more queued messages for the same connection without waiting.
+		while len(batch) < self.batch_size:
+			try:
+				item = self.queue.get_nowait()
+			except Empty:
+				break
+			if item is None:
+				self.queue.task_done()
+				return batch, True
+			batch.append(item)
+		return batch, False
+
+	def _send_batch(self, pending):
+		"""
+		Send the messages over one connection, sent and given up messages
+		are removed from pending.
+		:param pending: list of (message, queued at)
+		"""
+		attempt = 0
+		tries = {}
+		while pending:
+			try:
+				with mail.connect() as conn:
+					while pending:
+						msg, queued_at = pending.pop(0)
+						started = monotonic()
+						try:
+							conn.send(msg)
+						except Exception as e:
+							if not message_error(e):
+								pending.insert(0, (msg, queued_at))
+								raise
+							tries[id(msg)] = tries.get(id(msg), 0) + 1
+							if temporary_error(e) and tries[id(msg)] <= self.max_retries:
+								self.retries += 1
+								pending.append((msg, queued_at))
+							else:
+								self._give_up(msg, e)
+							continue
+						self._record(started, queued_at)
+						attempt = 0
+			except OSError as e:
+				self.app.logger.warning('Sending email failed (attempt %d): %s',
+										attempt + 1, e)
+				if attempt >= self.max_retries:
+					while pending:
+						self._give_up(pending.pop(0)[0], e)
+					return
+				self.retries += 1
+				sleep(self.retry_delay * 2 ** attempt)
+				attempt += 1
+
+	def _give_up(self, msg, error):
+		with self._lock:
+			self.failed += 1
+		self.app.logger.error('Give up sending email to %s: %s', msg.recipients, error)
+
+	def _record(self, started, queued_at):
+		now = monotonic()
+		latency = now - queued_at
+		metrics.mail_send_duration.observe(now - started)
+		with self._lock:
+			self.sent += 1
+			self.total_send_time += now - started
+			self.total_latency += latency
+			self.max_latency = max(self.max_latency, latency)
+
+
+dispatcher = MailDispatcher()
+atexit.register(dispatcher.shutdown)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
 	msg = Message(subject, sender=sender, recipients=recipients)
 	msg.body = text_body
 	msg.html = html_body
-	Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+	dispatcher.submit(msg)
@@ -1,4 +1,4 @@
-from flask import render_template, request
+from flask import render_template, request, make_response
 from app import db
 from . import bp
 from app.api.errors import error_response as api_error_response
@@ -12,6 +12,19 @@ def not_found_error(error):
 	return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+	if wants_json_response():
+		response = api_error_response(429, error.description)
+	else:
+		response = render_template('errors/429.html', message=error.description), 429
+	response = make_response(response)
+	retry_after = getattr(error, 'retry_after', None)
+	if retry_after:
+		response.headers['Retry-After'] = str(retry_after)
+	return response
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
 	db.session.rollback()
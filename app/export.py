@@ -0,0 +1,104 @@
+import csv
+import io
+import json
+from app import db
+from app.models import User, Car, CarLanguage, usercar_table
+from app.reference import reference
+
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def users_export(lang_code):
+	fields = ('id', 'username', 'email', 'language_code', 'role', 'car_count',
+			  'timestamp')
+	query = db.select([User.id, User.username, User.email, User.language_id,
+					   User.role_id, User.car_count, User.timestamp]) \
+		.order_by(User.id)
+	# Languages and roles come from the registry instead of joins.
+	languages = {lang.id: lang.code for lang in reference.languages()}
+	roles = {role.id: role.name for role in reference.roles()}
+	def to_row(row):
+		return (row[0], row[1], row[2], languages.get(row[3]), roles.get(row[4]),
+				row[5], isoformat(row[6]))
+	return fields, query, to_row
+
+def cars_export(lang_code):
+	fields = ('id', 'year', 'timestamp', 'users_count', 'name', 'default_name')
+	names = CarLanguage.__table__.alias('name')
+	default_names = CarLanguage.__table__.alias('default_name')
+	language = reference.language_by_code(lang_code)
+	default_language = reference.language_by_code('en')
+	# Both names are joined, so a car is one row.
+	query = db.select([Car.id, Car.year, Car.timestamp, Car.users_count,
+					   names.c.name, default_names.c.name]) \
+		.select_from(Car.__table__
+			.outerjoin(names, db.and_(names.c.car_id == Car.id,
+				names.c.language_id == language.id))
+			.outerjoin(default_names, db.and_(default_names.c.car_id == Car.id,
+				default_names.c.language_id == getattr(default_language, 'id', None)))) \
+		.order_by(Car.id)
+	def to_row(row):
+		return (row[0], row[1], isoformat(row[2]), row[3], row[4] or row[5], row[5])
+	return fields, query, to_row
+
+def user_cars_export(lang_code):
+	fields = ('user_id', 'car_id')
+	query = db.select([usercar_table.c.user_id, usercar_table.c.car_id]) \
+		.order_by(usercar_table.c.user_id, usercar_table.c.car_id)
+	return fields, query, tuple
+
+EXPORTS = {
+	'users': users_export,
+	'cars': cars_export,
+	'user_cars': user_cars_export
+}
+
+
+def export(kind, format='ndjson', lang_code='en', batch_size=1000):
+	"""
+	Return a generator of text chunks with every row of the kind,
+	one chunk per batch of rows.
+	:param kind: 'users', 'cars' or 'user_cars'
+	:param format: 'ndjson' or 'csv'
+	:param lang_code: language of cars' names
+	:param batch_size: rows fetched from the cursor at once
+	:raise ValueError: if an argument is not valid
+	"""
+	if kind not in EXPORTS:
+		raise ValueError('kind must be one of: {}'.format(', '.join(EXPORTS)))
+	if format not in EXPORT_FORMATS:
+		raise ValueError('format must be one of: {}'.format(', '.join(EXPORT_FORMATS)))
+	if reference.language_by_code(lang_code) is None:
+		raise ValueError('unknown language: {}'.format(lang_code))
+	fields, query, to_row = EXPORTS[kind](lang_code)
+	return generate(fields, query, to_row, format, batch_size)
+
+def generate(fields, query, to_row, format, batch_size):
+	# A server-side cursor where the driver supports it (PostgreSQL),
+	# so memory doesn't grow with the table.
+	result = db.session.execute(query.execution_options(stream_results=True))
+	try:
+		if format == 'csv':
+			yield to_csv([fields])
+		while True:
+			rows = result.fetchmany(batch_size)
+			if not rows:
+				break
+			rows = [to_row(row) for row in rows]
+			if format == 'csv':
+				yield to_csv(rows)
+			else:
+				yield ''.join(json.dumps(dict(zip(fields, row)), ensure_ascii=False)
+							  + '\n' for row in rows)
+	finally:
+		result.close()
+
+def to_csv(rows):
+	buffer = io.StringIO()
+	csv.writer(buffer).writerows(rows)
+	return buffer.getvalue()
+
+def isoformat(value):
+	return value.isoformat() if value is not None else None
@@ -1,9 +1,10 @@
-from datetime import datetime
-from random import randint
-from sqlalchemy.exc import IntegrityError
+from collections import Counter
+from datetime import datetime, timedelta
+from random import Random
 from faker import Faker
 from app import db
-from app.models import User, Car, CarLanguage, Language
+from app.models import User, Car, CarLanguage, Language, Role, Change, usercar_table, \
+	hash_password
 
 
 car_names = [
@@ -16,46 +17,120 @@ car_names = [
 ('Cadilac', 'Кадилак')
 ]
 
+# Faker is slow, so names are taken from a pool generated once.
+NAMES_POOL_SIZE = 1000
 
-def users(count=100):
-	fake = Faker()
-	i = 0
-	lang_count = Language.query.count()
-	while i < int(count):
-		u = User(username=fake.user_name(),
-				 email=fake.email()
-		)
-		u.language = Language.query.offset(randint(0, lang_count - 1)).first()
-		u.set_password('password')
-		db.session.add(u)
-		try:
-			db.session.commit()
-			i += 1
-		except IntegrityError:
-			db.session.rollback()
-	print('{} fake users were successfully created.'.format(i))
 
-def cars(count=100):
+def users(count=100, batch_size=1000, seed=None, password='password',
+		  password_hash=None):
+	"""
+	Create fake users with bulk inserts.
+	:param batch_size: how many users are inserted by one statement
+	:param seed: make the generated data reproducible
+	:param password_hash: hash saved for every user, by default
+						  the password is hashed once
+	"""
+	count = int(count)
+	rnd = Random(seed)
 	fake = Faker()
-	i = 0
-	user_count = User.query.count()
+	fake.seed_instance(seed)
+	user_names = [fake.user_name() for i in range(NAMES_POOL_SIZE)]
+	domains = [fake.free_email_domain() for i in range(10)]
+	lang_ids = [id for id, in db.session.query(Language.id)]
+	role = Role.query.filter_by(default=True).first()
+	if password_hash is None:
+		password_hash = hash_password(password)
+	# Numeric suffix keeps usernames and emails unique.
+	offset = db.session.query(db.func.max(User.id)).scalar() or 0
+	now = datetime.utcnow()
+	created = 0
+	while created < count:
+		rows = []
+		for n in range(offset + created + 1,
+					   offset + min(count, created + batch_size) + 1):
+			username = '{}{}'.format(rnd.choice(user_names), n)
+			rows.append({
+				'username': username,
+				'email': '{}@{}'.format(username, rnd.choice(domains)),
+				'password_hash': password_hash,
+				'language_id': rnd.choice(lang_ids),
+				'role_id': role.id if role else None,
+				'timestamp': now - timedelta(seconds=rnd.randint(0, 3600 * 24 * 365)),
+				'car_count': 0
+			})
+		last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+		db.session.execute(User.__table__.insert(), rows)
+		Change.record(db.session, 'user', [id for id, in db.session.query(User.id)
+										   .filter(User.id > last_id)])
+		db.session.commit()
+		created += len(rows)
+		print('{} of {} fake users were created.'.format(created, count))
+	print('{} fake users were successfully created.'.format(created))
+
+def cars(count=100, batch_size=1000, seed=None):
+	"""
+	Create fake cars with names in every language and add each one
+	to a random user, with bulk inserts.
+	:param batch_size: how many cars are inserted by one statement
+	:param seed: make the generated data reproducible
+	"""
+	count = int(count)
+	rnd = Random(seed)
 	langs = Language.query.all()
-	car_names_len = len(car_names)
-	while i < int(count):
-		u = User.query.offset(randint(0, user_count - 1)).first()
-		c = Car()
-		c.year = randint(1970, datetime.now().year)
-		c.timestamp = fake.past_date()
-		c.users.append(u)
-		for lang in langs:
-			if lang.code == 'en':
-				c.set_name(lang, car_names[randint(0, car_names_len - 1)][0])
-			elif lang.code == 'ru':
-				c.set_name(lang, car_names[randint(0, car_names_len - 1)][1])
-		db.session.add(c)
-		try:
-			db.session.commit()
-			i += 1
-		except IntegrityError:
-			db.session.rollback()
-		print('{} fake cars were successfully created.'.format(i))
\ No newline at end of file
+	user_ids = [id for id, in db.session.query(User.id)]
+	if not user_ids:
+		print('Create users first.')
+		return
+	# Ids are set explicitly to insert names and usercar rows without
+	# reading the new cars back.
+	next_id = (db.session.query(db.func.max(Car.id)).scalar() or 0) + 1
+	now = datetime.utcnow()
+	this_year = now.year
+	created = 0
+	while created < count:
+		car_rows, name_rows, usercar_rows = [], [], []
+		car_counts = Counter()
+		for i in range(min(batch_size, count - created)):
+			car_id = next_id + created + i
+			user_id = rnd.choice(user_ids)
+			name = rnd.choice(car_names)
+			car_rows.append({
+				'id': car_id,
+				'year': str(rnd.randint(1970, this_year)),
+				'timestamp': now - timedelta(days=rnd.randint(1, 365)),
+				'users_count': 1
+			})
+			for lang in langs:
+				name_rows.append({
+					'car_id': car_id,
+					'language_id': lang.id,
+					'name': name[1] if lang.code == 'ru' else name[0]
+				})
+			usercar_rows.append({'user_id': user_id, 'car_id': car_id})
+			car_counts[user_id] += 1
+		db.session.execute(Car.__table__.insert(), car_rows)
+		db.session.execute(CarLanguage.__table__.insert(), name_rows)
+		db.session.execute(usercar_table.insert(), usercar_rows)
+		db.session.execute(User.__table__.update()
+			.where(User.id == db.bindparam('user_id'))
+			.values(car_count=User.car_count + db.bindparam('cars'),
+					version=User.version + 1),
+			[{'user_id': user_id, 'cars': n} for user_id, n in car_counts.items()])
+		Change.record(db.session, 'car', [row['id'] for row in car_rows])
+		Change.record(db.session, 'user', car_counts)
+		Change.record(db.session, 'user_car',
+					  [(row['user_id'], row['car_id']) for row in usercar_rows])
+		db.session.commit()
+		created += len(car_rows)
+		print('{} of {} fake cars were created.'.format(created, count))
+	sync_sequence(Car)
+	print('{} fake cars were successfully created.'.format(created))
+
+def sync_sequence(model):
+	"""Move PostgreSQL id sequence past the explicitly inserted ids."""
+	if db.engine.dialect.name != 'postgresql':
+		return
+	table = model.__table__.name
+	db.session.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+					   "(SELECT MAX(id) FROM {0}))".format(table))
+	db.session.commit()
@@ -0,0 +1,151 @@
+from flask import current_app, has_app_context
+from flask_login import current_user
+from markupsafe import Markup
+from app.backends import load_backend, redis_client
+from app.cache import TTLCache
+from app.metrics import metrics
+
+
+class MemoryBackend(TTLCache):
+	"""Bounded LRU of rendered rows, every worker keeps its own."""
+
+	def __init__(self, app):
+		super(MemoryBackend, self).__init__(app.config['FRAGMENT_CACHE_SIZE'],
+											app.config['FRAGMENT_CACHE_TTL'])
+
+	def get_many(self, keys):
+		values = {}
+		for key in keys:
+			value = self.get(key)
+			if value is not None:
+				values[key] = value
+		return values
+
+	def set_many(self, mapping):
+		for key, value in mapping.items():
+			self.set(key, value)
+
+	def delete_entities(self, entities):
+		"""
+		Delete rows of the entities with one pass over the keys.
+		:param entities: set of (kind, id)
+		"""
+		prefixes = {'{}:{}'.format(kind, id) for kind, id in entities}
+		with self._lock:
+			for key in [key for key in self._data
+						if ':'.join(key.split(':', 2)[:2]) in prefixes]:
+				del self._data[key]
+
+
+class RedisBackend(object):
+	"""Rows shared by all workers in Redis at FRAGMENT_CACHE_URL."""
+
+	def __init__(self, app):
+		self.client = redis_client(app.config['FRAGMENT_CACHE_URL'], 'FRAGMENT_CACHE_BACKEND redis')
+		self.ttl = app.config['FRAGMENT_CACHE_TTL']
+		self.prefix = 'fragment:'
+
+	def get_many(self, keys):
+		values = self.client.mget([self.prefix + key for key in keys])
+		return {key: value.decode('utf-8') for key, value in zip(keys, values)
+				if value is not None}
+
+	def set_many(self, mapping):
+		pipe = self.client.pipeline(transaction=False)
+		for key, value in mapping.items():
+			pipe.set(self.prefix + key, value, ex=self.ttl)
+		pipe.execute()
+
+	def delete_entities(self, entities):
+		# Rows of older versions are never read again and expire after
+		# FRAGMENT_CACHE_TTL, finding them would scan the whole keyspace.
+		pass
+
+	def clear(self):
+		keys = list(self.client.scan_iter(self.prefix + '*'))
+		if keys:
+			self.client.delete(*keys)
+
+
+BACKENDS = {'memory': MemoryBackend, 'redis': RedisBackend}
+
+
+class FragmentCache(object):
+	"""
+	Cache of rendered list rows. A row is keyed by the template, the id and
+	version of its car or user, the viewer's language and role and the ids
+	of other template arguments, so a changed row gets a new key. Changed
+	entities are also deleted after commit to free the space. A failing
+	backend is logged and rows are rendered as if they were missed.
+	"""
+
+	def __init__(self, app=None):
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		name = app.config['FRAGMENT_CACHE_BACKEND']
+		app.extensions['fragment_cache'] = load_backend(name, BACKENDS, 'FRAGMENT_CACHE_BACKEND')(app) \
+			if name else None
+		app.add_template_global(self.rows, 'cached_rows')
+
+	@property
+	def backend(self):
+		return current_app.extensions.get('fragment_cache')
+
+	def rows(self, template, items, **context):
+		"""
+		Render the row template for every item, which is passed as 'car' or
+		'user'. Only missed rows are rendered, after a preload of their data.
+		Return a list of rows.
+		"""
+		if not items:
+			return []
+		kind = type(items[0]).__name__.lower()
+		viewer = '{}:{}'.format(current_user.language_id, current_user.role_id)
+		arguments = ','.join('{}={}'.format(name, getattr(value, 'id', value))
+							 for name, value in sorted(context.items()))
+		keys = ['{}:{}:{}:{}:{}:{}'.format(kind, item.id, item.version, template,
+										   viewer, arguments) for item in items]
+		cached = self._call('get_many', keys) or {}
+		missed = [(key, item) for key, item in zip(keys, items) if key not in cached]
+		metrics.fragment_cache.inc(len(keys) - len(missed), outcome='hit')
+		metrics.fragment_cache.inc(len(missed), outcome='miss')
+		if missed:
+			type(items[0]).preload([item for key, item in missed],
+								   lang_code=current_user.get_language().code)
+			row_template = current_app.jinja_env.get_template(template)
+			current_app.update_template_context(context)
+			rendered = {}
+			for key, item in missed:
+				context[kind] = item
+				rendered[key] = row_template.render(context)
+			self._call('set_many', rendered)
+			cached.update(rendered)
+		return [Markup(cached[key]) for key in keys]
+
+	def invalidate(self, entities):
+		""":param entities: set of (kind, id) of changed cars and users"""
+		if has_app_context() and entities:
+			self._call('delete_entities', entities)
+
+	def clear(self):
+		if has_app_context():
+			self._call('clear')
+
+	def _call(self, method, *args):
+		"""
+		Call the backend, return None if there is no backend or it failed.
+		Called after commit too, a failure must not fail the request.
+		"""
+		backend = self.backend
+		if backend is None:
+			return None
+		try:
+			return getattr(backend, method)(*args)
+		except Exception:
+			current_app.logger.warning('Fragment cache %s failed', method, exc_info=True)
+			return None
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,170 @@
+import csv
+import json
+import sys
+from datetime import datetime
+from app import db
+from app.fake import sync_sequence
+from app.models import Car, CarLanguage, Change
+from app.reference import reference
+
+
+def read_rows(file, format):
+	"""
+	Yield (line number, row dict) from a CSV file with a header
+	or from a file with a JSON object per line.
+	"""
+	if format == 'csv':
+		reader = csv.DictReader(file)
+		for row in reader:
+			yield reader.line_num, row
+	else:
+		for line_num, line in enumerate(file, 1):
+			if not line.strip():
+				continue
+			try:
+				row = json.loads(line)
+			except ValueError:
+				row = None
+			yield line_num, row
+
+def parse_row(row, languages, max_year):
+	"""
+	Return (car id or None, year, {language id: name}).
+	:param languages: {language code: language id}
+	:raise ValueError: if the row is not valid
+	"""
+	if not isinstance(row, dict):
+		raise ValueError('not an object')
+	car_id = row.get('id')
+	if car_id in (None, ''):
+		car_id = None
+	else:
+		try:
+			car_id = int(car_id)
+		except (TypeError, ValueError):
+			raise ValueError('id must be an integer')
+		if car_id <= 0:
+			raise ValueError('id must be positive')
+	try:
+		year = int(row.get('year'))
+	except (TypeError, ValueError):
+		raise ValueError('year must be an integer')
+	if not 1900 <= year <= max_year:
+		raise ValueError('year must be between 1900 and {}'.format(max_year))
+	names = {}
+	for key, value in row.items():
+		if key in ('id', 'year') or value in (None, ''):
+			continue
+		if key not in languages:
+			raise ValueError('unknown language: {}'.format(key))
+		if not isinstance(value, str) or len(value) > 124:
+			raise ValueError('{} name must be a string up to 124 characters'.format(key))
+		names[languages[key]] = value.strip()
+	return car_id, str(year), names
+
+def import_cars(file, format='csv', batch_size=1000, max_rejects=100):
+	"""
+	Insert or update cars and their names from a file, a batch of rows
+	per transaction. A row has the year, a name per language code and
+	optionally the id of the car to update.
+	:param max_rejects: how many rejected rows are printed
+	Return (imported rows, rejected rows).
+	"""
+	# Language codes are resolved once.
+	languages = {lang.code: lang.id for lang in reference.languages()}
+	english = languages.get('en')
+	max_year = datetime.now().year
+	next_id = (db.session.query(db.func.max(Car.id)).scalar() or 0) + 1
+	imported = rejected = 0
+	batch = {}
+
+	def reject(line_num, reason):
+		nonlocal rejected
+		rejected += 1
+		if rejected <= max_rejects:
+			print('Line {}: {}.'.format(line_num, reason), file=sys.stderr)
+
+	def flush():
+		nonlocal imported
+		skipped = save_batch(batch, english)
+		for line_num in skipped:
+			reject(line_num, 'new car must have an en name')
+		imported += len(batch) - len(skipped)
+		batch.clear()
+		print('{} cars were imported, {} rows rejected.'.format(imported, rejected))
+
+	for line_num, row in read_rows(file, format):
+		try:
+			car_id, year, names = parse_row(row, languages, max_year)
+		except ValueError as e:
+			reject(line_num, e)
+			continue
+		# Ids above every known id are new cars, others are looked up.
+		if car_id is None:
+			if english not in names:
+				reject(line_num, 'new car must have an en name')
+				continue
+			car_id = next_id
+			next_id += 1
+			new = True
+		else:
+			next_id = max(next_id, car_id + 1)
+			new = False
+			if car_id in batch:
+				flush()
+		batch[car_id] = (line_num, year, names, new)
+		if len(batch) >= batch_size:
+			flush()
+	if batch:
+		flush()
+	sync_sequence(Car)
+	print('{} cars were successfully imported, {} rows rejected.'.format(
+		imported, rejected))
+	return imported, rejected
+
+def save_batch(batch, english):
+	"""
+	Write a batch {car id: (line number, year, names, new)} with bulk
+	statements. Return line numbers of new cars skipped for having no en name.
+	"""
+	ids = [car_id for car_id, row in batch.items() if not row[3]]
+	existing = {car_id for car_id, in
+				db.session.query(Car.id).filter(Car.id.in_(ids))} if ids else set()
+	existing_names = set(db.session.query(CarLanguage.car_id, CarLanguage.language_id)
+						 .filter(CarLanguage.car_id.in_(existing))) if existing else set()
+	skipped = []
+	new_cars, updated_cars, new_names, updated_names = [], [], [], []
+	for car_id, (line_num, year, names, new) in batch.items():
+		if car_id in existing:
+			updated_cars.append({'b_car_id': car_id, 'b_year': year})
+		elif english not in names:
+			skipped.append(line_num)
+			continue
+		else:
+			new_cars.append({'id': car_id, 'year': year})
+		for language_id, name in names.items():
+			if (car_id, language_id) in existing_names:
+				updated_names.append({'b_car_id': car_id, 'b_language_id': language_id,
+									  'b_name': name})
+			else:
+				new_names.append({'car_id': car_id, 'language_id': language_id,
+								  'name': name})
+	if new_cars:
+		db.session.execute(Car.__table__.insert(), new_cars)
+	if updated_cars:
+		db.session.execute(Car.__table__.update()
+			.where(Car.id == db.bindparam('b_car_id'))
+			.values(year=db.bindparam('b_year'), version=Car.version + 1),
+			updated_cars)
+	if new_names:
+		db.session.execute(CarLanguage.__table__.insert(), new_names)
+	if updated_names:
+		db.session.execute(CarLanguage.__table__.update()
+			.where(db.and_(CarLanguage.car_id == db.bindparam('b_car_id'),
+						   CarLanguage.language_id == db.bindparam('b_language_id')))
+			.values(name=db.bindparam('b_name')),
+			updated_names)
+	Change.record(db.session, 'car', [row['id'] for row in new_cars] +
+				  [row['b_car_id'] for row in updated_cars])
+	db.session.commit()
+	return skipped
@@ -1,7 +1,8 @@
 from flask import render_template, flash, redirect, url_for, request, current_app
 from flask_login import current_user, login_required
 from app import db
-from app.models import User, Language, Car
+from app.models import User, Car
+from app.reference import reference
 from .forms import EditProfileForm
 from . import bp
 from app.decorators import admin_required
@@ -41,9 +42,9 @@ def edit_profile():
 	form = EditProfileForm(current_user.username)
 	if form.validate_on_submit():
 		current_user.username = form.username.data
-		language = Language.query.get(int(form.language.data))
+		language = reference.language(int(form.language.data))
 		if language:
-			current_user.language = language
+			current_user.language_id = language.id
 		db.session.commit()
 		flash('Your changes have been saved.')
 		return redirect(url_for('.edit_profile'))
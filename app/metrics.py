@@ -0,0 +1,237 @@
+import hmac
+import threading
+from time import perf_counter
+from flask import Response, current_app, g, request, abort
+from sqlalchemy import exc
+from sqlalchemy.pool import Pool, QueuePool
+from app import db
+
+
+# Request latency buckets in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+	"""
+	A metric with labels in the Prometheus text format.
+	:param source: callable returning the value, or {label values: value},
+				   called on every scrape instead of recording values
+	"""
+	type = None
+
+	def __init__(self, name, documentation, labelnames=(), source=None):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self.source = source
+		self._values = {}
+		self._lock = threading.Lock()
+
+	def _key(self, labels):
+		if set(labels) != set(self.labelnames):
+			raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+		return tuple(str(labels[name]) for name in self.labelnames)
+
+	def samples(self):
+		"""Yield (suffix, label values, extra labels, value)."""
+		if self.source is not None:
+			values = self.source()
+			if not isinstance(values, dict):
+				values = {(): values}
+		else:
+			with self._lock:
+				values = dict(self._values)
+		for key, value in sorted(values.items()):
+			yield '', key, (), value
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.documentation),
+				 '# TYPE {} {}'.format(self.name, self.type)]
+		for suffix, key, extra, value in self.samples():
+			labels = list(zip(self.labelnames, key)) + list(extra)
+			lines.append('{}{}{} {}'.format(self.name, suffix,
+											format_labels(labels), format_value(value)))
+		return '\n'.join(lines)
+
+
+class Counter(Metric):
+	type = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+	type = 'gauge'
+
+	def set(self, value, **labels):
+		key = self._key(labels)
+		with self._lock:
+			self._values[key] = value
+
+
+class Histogram(Metric):
+	type = 'histogram'
+
+	def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+		super(Histogram, self).__init__(name, documentation, labelnames)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+		with self._lock:
+			counts = self._values.get(key)
+			if counts is None:
+				# Bucket counts, then +Inf count and the sum.
+				counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+			counts[-2] += 1
+			counts[-1] += value
+
+	def samples(self):
+		with self._lock:
+			values = {key: list(counts) for key, counts in self._values.items()}
+		for key, counts in sorted(values.items()):
+			for bound, count in zip(self.buckets, counts):
+				yield '_bucket', key, (('le', format_value(bound)),), count
+			yield '_bucket', key, (('le', '+Inf'),), counts[-2]
+			yield '_sum', key, (), counts[-1]
+			yield '_count', key, (), counts[-2]
+
+
+class Metrics(object):
+	"""
+	Process-wide metrics and the /metrics endpoint. With several workers
+	every worker has its own values, a scrape shows the worker it reached.
+	Labels are never user ids or URLs, only route endpoints.
+	"""
+
+	def __init__(self, app=None):
+		self._metrics = []
+		self.request_latency = self.add(Histogram('http_request_duration_seconds',
+			'Request latency.', ('blueprint', 'endpoint', 'method')))
+		self.requests = self.add(Counter('http_requests_total',
+			'Responses by status code.', ('blueprint', 'endpoint', 'method', 'status')))
+		self.db_checkouts = self.add(Counter('db_pool_checkouts_total',
+			'Connections checked out from the pool.'))
+		self.db_connects = self.add(Counter('db_pool_connects_total',
+			'New database connections.'))
+		self.db_checkout_wait = self.add(Histogram('db_pool_checkout_wait_seconds',
+			'Time to get a connection from the pool.'))
+		self.db_checkout_timeouts = self.add(Counter('db_pool_checkout_timeouts_total',
+			'Checkouts which timed out waiting for a connection.'))
+		self.db_checked_out = self.add(Gauge('db_pool_checked_out',
+			'Connections in use.', source=lambda: pool_stat('checkedout')))
+		self.db_checked_in = self.add(Gauge('db_pool_checked_in',
+			'Idle connections in the pool.', source=lambda: pool_stat('checkedin')))
+		self.db_pool_size = self.add(Gauge('db_pool_size',
+			'Connections the pool keeps open.', source=lambda: pool_stat('size')))
+		self.db_pool_overflow = self.add(Gauge('db_pool_overflow',
+			'Connections opened over the pool size.', source=lambda: pool_stat('overflow')))
+		self.mail_send_duration = self.add(Histogram('mail_send_duration_seconds',
+			'Time to send one email over SMTP.'))
+		self.mail_sent = self.add(Counter('mail_sent_total', 'Sent emails.',
+			source=lambda: mail_stats()['sent']))
+		self.mail_failed = self.add(Counter('mail_failed_total',
+			'Emails given up after retries.', source=lambda: mail_stats()['failed']))
+		self.mail_dropped = self.add(Counter('mail_dropped_total',
+			'Emails dropped because the queue was full.',
+			source=lambda: mail_stats()['dropped']))
+		self.mail_retries = self.add(Counter('mail_retries_total',
+			'Retried email batches.', source=lambda: mail_stats()['retries']))
+		self.mail_queue_depth = self.add(Gauge('mail_queue_depth',
+			'Emails waiting in the queue.', source=lambda: mail_stats()['queue_depth']))
+		self.auth_attempts = self.add(Counter('auth_attempts_total',
+			'API authentication attempts by outcome.', ('method', 'outcome')))
+		self.fragment_cache = self.add(Counter('fragment_cache_rows_total',
+			'Rendered list rows by cache outcome.', ('outcome',)))
+		self.rate_limited = self.add(Counter('rate_limited_total',
+			'Requests rejected by rate limits.', ('policy',)))
+		if app is not None:
+			self.init_app(app)
+
+	def add(self, metric):
+		self._metrics.append(metric)
+		return metric
+
+	def init_app(self, app):
+		app.extensions['metrics'] = self
+		app.before_request(self._before_request)
+		app.after_request(self._after_request)
+		app.add_url_rule('/metrics', 'metrics', self.view)
+
+	def _before_request(self):
+		g.metrics_started = perf_counter()
+
+	def _after_request(self, response):
+		started = g.pop('metrics_started', None)
+		blueprint = request.blueprint or 'none'
+		# Unmatched URLs have no endpoint, their paths are not labels.
+		endpoint = request.endpoint or 'unknown'
+		if started is not None:
+			self.request_latency.observe(perf_counter() - started,
+				blueprint=blueprint, endpoint=endpoint, method=request.method)
+		self.requests.inc(blueprint=blueprint, endpoint=endpoint,
+						  method=request.method, status=response.status_code)
+		return response
+
+	def render(self):
+		return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+	def view(self):
+		token = current_app.config['METRICS_TOKEN']
+		if token:
+			auth = request.headers.get('Authorization', '')
+			if not hmac.compare_digest(auth, 'Bearer ' + token):
+				abort(401)
+		return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+
+class MeasuredQueuePool(QueuePool):
+	"""QueuePool which reports how long checkouts wait for a connection."""
+
+	def _do_get(self):
+		started = perf_counter()
+		try:
+			return super(MeasuredQueuePool, self)._do_get()
+		except exc.TimeoutError:
+			metrics.db_checkout_timeouts.inc()
+			raise
+		finally:
+			metrics.db_checkout_wait.observe(perf_counter() - started)
+
+
+def pool_stat(key):
+	from app.database import pool_stats
+	return pool_stats(db.engine)[key] or 0
+
+def mail_stats():
+	from app.email import dispatcher
+	return dispatcher.stats()
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\')
+		.replace('"', r'\"').replace('\n', r'\n')) for name, value in labels) + '}'
+
+def format_value(value):
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+
+metrics = Metrics()
+
+
+@db.event.listens_for(Pool, 'checkout')
+def pool_checkout(dbapi_connection, connection_record, connection_proxy):
+	metrics.db_checkouts.inc()
+
+@db.event.listens_for(Pool, 'connect')
+def pool_connect(dbapi_connection, connection_record):
+	metrics.db_connects.inc()
@@ -4,10 +4,17 @@ from hashlib import md5
 from datetime import datetime, timedelta
 from time import time
 import jwt
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import current_app, url_for
-from app import db, login
+from werkzeug.security import generate_password_hash, check_password_hash, \
+	DEFAULT_PBKDF2_ITERATIONS
+from flask import current_app, url_for, g
+from sqlalchemy.dialects import postgresql
+from app import db, login, token_cache
 from flask_login import UserMixin, AnonymousUserMixin
+from app.reference import reference
+from app.metrics import metrics
+from app import search
+from app.fragments import fragment_cache
+from app.replicas import use_primary
 
 
 ### Mixins classes ###
@@ -21,8 +28,46 @@ class FormChoicesMixin(object):
 		return choices
 
 class PaginatedAPIMixin(object):
+	# Keys of to_dict(), clients can ask for a part of them with ?fields=.
+	api_fields = ()
+
+	@classmethod
+	def preload(cls, items, **kwargs):
+		"""Load related data for a whole page of items at once."""
+		pass
+
+	@classmethod
+	def parse_fields(cls, value):
+		"""
+		Parse comma-separated field names, the id is always included.
+		Return a set of fields or None for all fields.
+		:raise ValueError: if a field is unknown
+		"""
+		if not value:
+			return None
+		fields = {field.strip() for field in value.split(',') if field.strip()}
+		unknown = fields - set(cls.api_fields)
+		if unknown:
+			raise ValueError('unknown fields: {}'.format(', '.join(sorted(unknown))))
+		fields.add('id')
+		return fields
+
+	@staticmethod
+	def fields_to_dict(getters, fields=None):
+		"""Call the getters of the requested fields only."""
+		return {field: get() for field, get in getters.items()
+				if fields is None or field in fields}
+
 	@staticmethod
-	def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+	def to_collection_dict(query, page, per_page, endpoint, cursor=None,
+						   key=None, with_total=False, fields=None, **kwargs):
+		"""
+		:param fields: set of item fields to return, see parse_fields()
+		"""
+		if cursor is not None:
+			return PaginatedAPIMixin.to_cursor_dict(query, cursor, per_page,
+				endpoint, key=key, with_total=with_total, fields=fields, **kwargs)
+		links = PaginatedAPIMixin.link_args(fields, kwargs)
 		resources = query.paginate(page, per_page, False)
 		data = {
 			'meta': {
@@ -33,20 +78,91 @@ class PaginatedAPIMixin(object):
 			},
 			'_links': {
 				'self': url_for(endpoint, page=page, per_page=per_page,
-								**kwargs),
+								**links),
 				'next': url_for(endpoint, page=page + 1, per_page=per_page,
-								**kwargs) if resources.has_next else None,
+								**links) if resources.has_next else None,
 				'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-								**kwargs) if resources.has_prev else None
+								**links) if resources.has_prev else None
+			}
+		}
+		data['items'] = PaginatedAPIMixin.items_to_dict(resources.items,
+														fields=fields, **kwargs)
+		return data
+
+	@staticmethod
+	def to_cursor_dict(query, cursor, per_page, endpoint, key=None,
+					   with_total=False, fields=None, **kwargs):
+		"""
+		Keyset pagination: return items which key is greater than the cursor.
+		Every page costs the same, no OFFSET scan and no COUNT unless asked.
+		:param cursor: opaque string from a previous page or '' for the first page
+		:param key: indexed column the items are ordered on, its value must
+					be equal to the item's id. Default is the entity's id.
+		:raise ValueError: if the cursor is not valid
+		"""
+		if key is None:
+			key = query.column_descriptions[0]['entity'].id
+		last_id = PaginatedAPIMixin.decode_cursor(cursor)
+		items_query = query.order_by(None).order_by(key.asc())
+		if last_id is not None:
+			items_query = items_query.filter(key > last_id)
+		# Fetch one extra item to know whether there is a next page.
+		items = items_query.limit(per_page + 1).all()
+		has_next = len(items) > per_page
+		items = items[:per_page]
+		next_cursor = PaginatedAPIMixin.encode_cursor(items[-1].id) \
+			if has_next else None
+		links = PaginatedAPIMixin.link_args(fields, kwargs)
+		data = {
+			'meta': {
+				'per_page': per_page,
+				'cursor': cursor,
+				'next_cursor': next_cursor
+			},
+			'_links': {
+				'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+								**links),
+				'next': url_for(endpoint, cursor=next_cursor, per_page=per_page,
+								**links) if has_next else None
 			}
 		}
+		if with_total:
+			data['meta']['total_items'] = query.order_by(None).count()
+		data['items'] = PaginatedAPIMixin.items_to_dict(items, fields=fields,
+														**kwargs)
+		return data
+
+	@staticmethod
+	def link_args(fields, kwargs):
+		# Pages of a sparse collection keep the same fields.
+		if fields is None:
+			return kwargs
+		return dict(kwargs, fields=','.join(sorted(fields)))
+
+	@staticmethod
+	def items_to_dict(items, fields=None, **kwargs):
+		if items:
+			items[0].preload(items, fields=fields, **kwargs)
 		if kwargs.get('lang_code'):
-			data['items'] = [item.to_dict(lang_code=kwargs['lang_code']) for item in resources.items]
+			return [item.to_dict(lang_code=kwargs['lang_code'], fields=fields)
+					for item in items]
 		elif kwargs.get('include_email'):
-			data['items'] = [item.to_dict(include_email=kwargs['include_email']) for item in resources.items]
-		else:
-			data['items'] = [item.to_dict() for item in resources.items]
-		return data
+			return [item.to_dict(include_email=kwargs['include_email'],
+								 fields=fields) for item in items]
+		return [item.to_dict(fields=fields) for item in items]
+
+	@staticmethod
+	def encode_cursor(id):
+		return base64.urlsafe_b64encode(str(id).encode('utf-8')).decode('utf-8')
+
+	@staticmethod
+	def decode_cursor(cursor):
+		if not cursor:
+			return None
+		try:
+			return int(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+		except (TypeError, ValueError, UnicodeError) as e:
+			raise ValueError('invalid cursor') from e
 
 ### End Mixins classes ###
 
@@ -105,6 +221,10 @@ class Role(FormChoicesMixin, db.Model):
 	def get_name(self):
 		return self.name
 
+	@classmethod
+	def choices(cls):
+		return [(role.id, role.get_name()) for role in reference.roles()]
+
 
 ########################
 ###### USER MODEL ######
@@ -117,10 +237,14 @@ usercar_table = db.Table('usercar', db.Model.metadata,
 	)
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
+	# Email is only in the change feed, it can't be asked for.
+	api_fields = ('id', 'username', 'language_code', 'car_count', '_links')
+	# Changes of these don't bump the version or get into the change feed.
+	unversioned_columns = ('token', 'token_expiration', 'password_hash')
 	id = db.Column(db.Integer, primary_key=True)
 	username = db.Column(db.String(64), index=True, unique=True)
 	email = db.Column(db.String(120), index=True, unique=True)
-	password_hash = db.Column(db.String(128))
+	password_hash = db.Column(db.String(256))
 	language_id = db.Column(db.Integer, db.ForeignKey('language.id'))
 	language = db.relationship('Language', back_populates='users')
 	role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
@@ -129,24 +253,49 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 	timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 	token = db.Column(db.String(32), index=True, unique=True)
 	token_expiration = db.Column(db.DateTime)
+	car_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+	# Incremented on every update but of unversioned_columns, used for ETags.
+	version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 	def __init__(self, **kwargs):
 		super(User, self).__init__(**kwargs)
-		if self.role is None:
+		if self.role is None and self.role_id is None:
+			role = None
 			if self.email == current_app.config['ADMINS'][0]:
-				self.role = Role.query.filter_by(name='Administrator').first()
-			if self.role is None:
-				self.role = Role.query.filter_by(default=True).first()
+				role = reference.role_by_name('Administrator')
+			if role is None:
+				role = reference.default_role()
+			if role is not None:
+				self.role_id = role.id
 
 	def __repr__(self):
 		return '<User {}>'.format(self.username)
 
 	def set_password(self, password):
-		self.password_hash = generate_password_hash(password)
+		self.password_hash = hash_password(password)
 
 	def check_password(self, password):
 		return check_password_hash(self.password_hash, password)
 
+	def password_needs_rehash(self):
+		"""Check if the stored hash was made with other than the current settings."""
+		if not self.password_hash or self.password_hash.count('$') < 2:
+			return False
+		method, salt, hashval = self.password_hash.split('$', 2)
+		return method != password_hash_method() or \
+			len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
+
+	def upgrade_password(self, password):
+		"""
+		Rehash the checked password if the hash settings were changed.
+		Return True if the hash was updated.
+		"""
+		if not self.password_needs_rehash():
+			return False
+		self.set_password(password)
+		return True
+
 	def get_reset_password_token(self, expires_in=600):
 		return jwt.encode(
 			{'reset_password': self.id, 'exp': time() + expires_in},
@@ -162,7 +311,11 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 		return User.query.get(id)
 
 	def can(self, perm):
-		return self.role is not None and self.role.has_permission(perm)
+		role = reference.role(self.role_id)
+		return role is not None and role.has_permission(perm)
+
+	def get_language(self):
+		return reference.language(self.language_id)
 
 	def is_administrator(self):
 		return self.can(Permission.ADMIN)
@@ -172,47 +325,223 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 		now = datetime.utcnow()
 		if self.token and self.token_expiration > now + timedelta(seconds=60):
 			return self.token
+		if self.token:
+			token_cache.delete(self.token)
 		self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
 		self.token_expiration = now + timedelta(seconds=expires_in)
 		db.session.add(self)
 		return self.token
 
 	def revoke_token(self):
+		"""
+		Expire the token. Verified tokens are cached per process, so other
+		workers can still accept it for up to TOKEN_CACHE_TTL seconds.
+		"""
+		token_cache.delete(self.token)
+		g.pop('token_principal', None)
 		self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
 
+	@staticmethod
+	def update_car_counts():
+		"""Recompute car_count of all users with one statement."""
+		count = db.select([db.func.count()]) \
+			.where(usercar_table.c.user_id == User.id).as_scalar()
+		Change.record(db.session, 'user', [id for id, in db.session.execute(
+			db.select([User.id]).where(User.car_count != count))])
+		db.session.execute(User.__table__.update()
+			.where(User.car_count != count)
+			.values(car_count=count, version=User.version + 1))
+
 	@staticmethod
 	def check_token(token):
-		user = User.query.filter_by(token=token).first()
-		if user is None or user.token_expiration < datetime.utcnow():
-			return None
-		return user
+		"""
+		Return the user of a valid token as a TokenUser, the row is
+		loaded only when a view needs more than permission checks.
+		"""
+		principal = User.token_principal(token)
+		return TokenUser(principal) if principal is not None else None
 
-	def to_dict(self, include_email=False):
-		data = {
-			'id': self.id,
-			'username': self.username,
-			'language_code': self.language.code,
-			'car_count': self.cars.count(),
-			'_links': {
+	@staticmethod
+	def token_principal(token):
+		"""
+		Return id, role_id, language_id and expiration of the user of
+		a valid token.
+		They are cached, so a cached token is verified without a query
+		for the token, once per request.
+		Return None if the token is invalid.
+		"""
+		checked = g.get('token_principal')
+		if checked is not None and checked[0] == token:
+			return checked[1]
+		principal = token_cache.get(token)
+		if principal is not None and principal['expiration'] > datetime.utcnow():
+			metrics.auth_attempts.inc(method='token', outcome='cached')
+		else:
+			# New and revoked tokens can lag on replicas.
+			with use_primary():
+				user = User.query.filter_by(token=token).first()
+			if user is None or user.token_expiration < datetime.utcnow():
+				metrics.auth_attempts.inc(method='token',
+					outcome='invalid' if user is None else 'expired')
+				g.token_principal = (token, None)
+				return None
+			metrics.auth_attempts.inc(method='token', outcome='valid')
+			principal = {'id': user.id, 'role_id': user.role_id,
+						 'language_id': user.language_id,
+						 'expiration': user.token_expiration}
+			ttl = (user.token_expiration - datetime.utcnow()).total_seconds()
+			token_cache.set(token, principal, ttl=ttl)
+		g.token_principal = (token, principal)
+		return principal
+
+	def add_cars(self, car_ids):
+		"""
+		Add many cars with one INSERT .. SELECT, skipping the cars
+		the user already has. Counters and versions are updated in bulk.
+		Return ids of the added cars.
+		"""
+		self._lock_cars()
+		assigned = db.select([usercar_table.c.car_id]) \
+			.where(usercar_table.c.user_id == self.id)
+		new_ids = [id for id, in db.session.query(Car.id)
+				   .filter(Car.id.in_(set(car_ids)), ~Car.id.in_(assigned))]
+		if not new_ids:
+			return []
+		result = db.session.execute(usercar_table.insert().from_select(
+			['user_id', 'car_id'],
+			db.select([db.literal(self.id), Car.id])
+				.where(Car.id.in_(new_ids)).where(~Car.id.in_(assigned))))
+		self._update_car_counters(new_ids, result.rowcount)
+		return new_ids
+
+	def remove_cars(self, car_ids):
+		"""
+		Remove many cars with one DELETE. Return ids of the removed cars.
+		"""
+		self._lock_cars()
+		removed_ids = [id for id, in db.session.query(usercar_table.c.car_id)
+					   .filter(usercar_table.c.user_id == self.id,
+							   usercar_table.c.car_id.in_(set(car_ids)))]
+		if not removed_ids:
+			return []
+		result = db.session.execute(usercar_table.delete()
+			.where(usercar_table.c.user_id == self.id)
+			.where(usercar_table.c.car_id.in_(removed_ids)))
+		self._update_car_counters(removed_ids, -result.rowcount)
+		return removed_ids
+
+	def _lock_cars(self):
+		"""
+		Bump the user's version first, so the row stays locked till commit.
+		Concurrent changes of the user's cars wait for each other and read
+		the assigned cars after the previous one committed.
+		"""
+		db.session.execute(User.__table__.update()
+			.where(User.id == self.id)
+			.values(version=User.version + 1))
+
+	def _update_car_counters(self, car_ids, count):
+		""":param count: added cars, negative for removed ones"""
+		if not count:
+			return
+		delta = 1 if count > 0 else -1
+		db.session.execute(Car.__table__.update()
+			.where(Car.id.in_(car_ids))
+			.values(users_count=Car.users_count + delta, version=Car.version + 1))
+		db.session.execute(User.__table__.update()
+			.where(User.id == self.id)
+			.values(car_count=User.car_count + count))
+		db.session.info.setdefault('fragments_changed', set()).update(
+			[('user', self.id)] + [('car', id) for id in car_ids])
+		Change.record(db.session, 'user', [self.id])
+		Change.record(db.session, 'car', car_ids)
+		Change.record(db.session, 'user_car', [(self.id, id) for id in car_ids],
+					  deleted=delta < 0)
+		# Core statements bypass the ORM, reload the changed rows.
+		car_ids = set(car_ids)
+		for obj in list(db.session.identity_map.values()):
+			if obj is self or isinstance(obj, Car) and obj.id in car_ids:
+				db.session.expire(obj)
+
+	def get_cars_version(self):
+		"""Return a string which changes when any of the user's cars changes."""
+		count, versions = db.session.query(db.func.count(Car.id),
+										   db.func.sum(Car.version)) \
+			.join(usercar_table, usercar_table.c.car_id == Car.id) \
+			.filter(usercar_table.c.user_id == self.id).one()
+		return '{}-{}'.format(count, versions or 0)
+
+	def to_dict(self, include_email=False, fields=None):
+		"""
+		:param fields: set of keys to return, by default all of them
+		"""
+		getters = {
+			'id': lambda: self.id,
+			'username': lambda: self.username,
+			'language_code': lambda: self.get_language().code,
+			'car_count': lambda: self.car_count,
+			'_links': lambda: {
 				'self': url_for('api.get_user', id=self.id),
 				'cars': url_for('api.get_user_cars', id=self.id)
 			}
 		}
 		if include_email:
-			data['email'] = self.email
-		return data
+			getters['email'] = lambda: self.email
+		return self.fields_to_dict(getters, fields)
 
 	def from_dict(self, data, new_user=False):
 		for field in ['username', 'email', 'language_code']:
 			if field in data:
 				if field == 'language_code':
-					language = Language.query.filter_by(code=data[field]).first()
-					setattr(self, 'language', language)
+					language = reference.language_by_code(data[field])
+					setattr(self, 'language_id', language.id if language else None)
 				setattr(self, field, data[field])
 		if new_user and 'password' in data:
 			self.set_password(data['password'])
 
 
+def hash_password(password):
+	return generate_password_hash(password,
+		method=current_app.config['PASSWORD_HASH_METHOD'],
+		salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+
+def password_hash_method():
+	"""Return the configured hash method the way werkzeug writes it into a hash."""
+	method = current_app.config['PASSWORD_HASH_METHOD']
+	if method.startswith('pbkdf2:') and method.count(':') == 1:
+		method = '{}:{}'.format(method, DEFAULT_PBKDF2_ITERATIONS)
+	return method
+
+
+class TokenUser(object):
+	"""
+	User of a token principal. Permissions and the language are checked
+	without a query, other attributes load the row on first use.
+	"""
+
+	def __init__(self, principal):
+		self.id = principal['id']
+		self.role_id = principal['role_id']
+		self.language_id = principal['language_id']
+		self._user = None
+
+	can = User.can
+	get_language = User.get_language
+	is_administrator = User.is_administrator
+
+	def __getattr__(self, name):
+		if self._user is None:
+			self._user = User.query.get(self.id)
+			if self._user is None:
+				# A new user can lag on replicas.
+				with use_primary():
+					self._user = User.query.get(self.id)
+		return getattr(self._user, name)
+
+	def __repr__(self):
+		return '<TokenUser {}>'.format(self.id)
+
+
 class AnonymousUser(AnonymousUserMixin):
 	def can(self, permissions):
 		return False
@@ -252,51 +581,163 @@ class Language(db.Model, FormChoicesMixin):
 	def get_name(self):
 		return self.name
 
+	@classmethod
+	def choices(cls):
+		return [(lang.id, lang.get_name()) for lang in reference.languages()]
+
 
 ########################
 ###### CAR MODEL ######
 ########################
-class Car(db.Model, FormChoicesMixin):
+class Car(PaginatedAPIMixin, db.Model, FormChoicesMixin):
+	# Indexes for the catalog filters: year range and timestamp window.
+	__table_args__ = (db.Index('ix_car_year_timestamp', 'year', 'timestamp'),)
+	api_fields = ('id', 'year', 'users_count', 'name', 'default_name', '_links')
 	id = db.Column(db.Integer, primary_key=True)
 	year = db.Column(db.String(4), index=True)
 	names = db.relationship('CarLanguage', cascade='all, delete-orphan', 
 							back_populates='car', lazy='dynamic')
-	timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+	timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 	users = db.relationship('User', secondary=usercar_table,
 			back_populates='cars', lazy='dynamic')
+	users_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+	# Incremented on every update of the car or its names, used for ETags.
+	version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 	def __repr__(self):
 		return '<Car {}>'.format(self.get_name('en'))
 
 	# Car names. 
 	def set_name(self, language, name):
-		self.names.append(CarLanguage(language, name))
+		self.names.append(CarLanguage(name=name, language_id=language.id))
+		self._names = None
+
+	@staticmethod
+	def load_names(cars, lang_code='en'):
+		"""
+		Load names in the selected and the default 'en' language
+		for many cars with one query.
+		:param cars: list of Car models
+		:param lang_code: language code, e.g. 'ru'
+		"""
+		cars = [car for car in cars if car.id is not None]
+		if not cars:
+			return
+		codes = {lang_code, 'en'}
+		langs = [reference.language_by_code(code) for code in codes]
+		lang_codes = {lang.id: lang.code for lang in langs if lang is not None}
+		rows = db.session.query(CarLanguage.car_id, CarLanguage.language_id,
+								CarLanguage.name) \
+			.filter(CarLanguage.car_id.in_([car.id for car in cars]),
+					CarLanguage.language_id.in_(lang_codes)).all()
+		names = {}
+		for car_id, language_id, name in rows:
+			names[(car_id, lang_codes[language_id])] = name
+		for car in cars:
+			if getattr(car, '_names', None) is None:
+				car._names = {}
+			for code in codes:
+				car._names[code] = names.get((car.id, code))
+
+	@classmethod
+	def preload(cls, items, lang_code='en', fields=None, **kwargs):
+		if fields is None or fields & {'name', 'default_name'}:
+			cls.load_names(items, lang_code)
+
+	@classmethod
+	def choices(cls):
+		cars = cls.query.all()
+		cls.load_names(cars)
+		return [(car.id, car.get_name()) for car in cars]
+
+	@staticmethod
+	def search_by_name(prefix, exclude_user=None, limit=20):
+		"""
+		Find cars which name in any language starts with the prefix.
+		The range condition is served by the index on car_language.name.
+		:param exclude_user: User model, skip cars the user already has
+		"""
+		query = Car.query
+		if prefix:
+			car_ids = db.session.query(CarLanguage.car_id).filter(
+				CarLanguage.name_startswith(prefix))
+			query = query.filter(Car.id.in_(car_ids))
+		if exclude_user is not None:
+			assigned = db.session.query(usercar_table.c.car_id) \
+				.filter(usercar_table.c.user_id == exclude_user.id)
+			query = query.filter(~Car.id.in_(assigned))
+		return query.order_by(Car.id).limit(limit).all()
+
+	@staticmethod
+	def catalog(year_from=None, year_to=None, name=None, lang_code='en',
+				since=None, until=None):
+		"""
+		Return query of cars filtered by a year range, a name prefix
+		in the language and a window of the timestamp.
+		Every filter is served by an index. Cars are ordered by id, or
+		by (timestamp, id) in a window, so the index of the timestamp
+		serves the window and the order without a sort.
+		"""
+		query = Car.query
+		if year_from:
+			query = query.filter(Car.year >= year_from)
+		if year_to:
+			query = query.filter(Car.year <= year_to)
+		if since:
+			query = query.filter(Car.timestamp >= since)
+		if until:
+			query = query.filter(Car.timestamp < until)
+		if name:
+			language = reference.language_by_code(lang_code)
+			query = query.join(CarLanguage, CarLanguage.car_id == Car.id) \
+				.filter(CarLanguage.language_id == (language.id if language else None),
+						CarLanguage.name_startswith(name))
+		if since or until:
+			return query.order_by(Car.timestamp, Car.id)
+		return query.order_by(Car.id)
 
 	def get_name(self, lang_code='en', year=True):
-		q = self.names.join('language').filter(Language.code==lang_code).first()
+		names = getattr(self, '_names', None)
+		if names is None or lang_code not in names or 'en' not in names:
+			Car.load_names([self], lang_code)
+			names = getattr(self, '_names', None) or {}
 		# If it does not have a name for the selected language, give the default 'en'.
-		if not q.name:
-			q = self.names.join('language').filter(Language.code=='en').first() 
+		name = names.get(lang_code) or names.get('en')
 		# Return without year.
-		if not self.year:
-			return q.name
+		if not self.year or name is None:
+			return name
 		# Return with year.
-		return '|'.join((q.name, self.year)) if year else q.name
+		return '|'.join((name, str(self.year))) if year else name
 
 	# Related to api functional.
-	def to_dict(self, lang_code='en'):
-		data = {
-			'id': self.id,
-			'year': self.year,
-			'users_count': self.users.count(),
-			'_links': {
+	def to_dict(self, lang_code='en', fields=None):
+		"""
+		:param fields: set of keys to return, by default all of them
+		"""
+		getters = {
+			'id': lambda: self.id,
+			'year': lambda: self.year,
+			'users_count': lambda: self.users_count,
+			'name': lambda: self.get_name(lang_code, False),
+			'_links': lambda: {
 				'self': url_for('api.get_car', id=self.id)
 			}
 		}
 		if lang_code != 'en':
-			data['default_name'] = self.get_name(year=False)
-		data['name'] = self.get_name(lang_code, False)
-		return data
+			getters['default_name'] = lambda: self.get_name(year=False)
+		return self.fields_to_dict(getters, fields)
+
+	@staticmethod
+	def update_users_counts():
+		"""Recompute users_count of all cars with one statement."""
+		count = db.select([db.func.count()]) \
+			.where(usercar_table.c.car_id == Car.id).as_scalar()
+		Change.record(db.session, 'car', [id for id, in db.session.execute(
+			db.select([Car.id]).where(Car.users_count != count))])
+		db.session.execute(Car.__table__.update()
+			.where(Car.users_count != count)
+			.values(users_count=count, version=Car.version + 1))
 
 	def from_dict(self, data):
 		pass
@@ -306,21 +747,329 @@ class Car(db.Model, FormChoicesMixin):
 # Association table.
 class CarLanguage(db.Model):
 	__tablename__ = 'car_language'
+	# Name prefix search within one language.
+	__table_args__ = (db.Index('ix_car_language_language_id_name', 'language_id', 'name'),)
 	car_id = db.Column(db.Integer, db.ForeignKey('car.id'), primary_key=True)
 	language_id = db.Column(db.Integer, db.ForeignKey('language.id'), primary_key=True)
 	name = db.Column(db.String(124), index=True, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 	car = db.relationship('Car', back_populates='names')
 	language = db.relationship('Language', back_populates='cars')
 
-	def __init__(self, language, name, **kwargs):
+	def __init__(self, language=None, name=None, **kwargs):
 		super(CarLanguage, self).__init__(**kwargs)
-		self.language = language
+		if language is not None:
+			self.language = language
 		self.name = name
 	
 	def __repr__(self):
-		return '<CarLanguage {} {}>'.format(self.language.code, self.name)
+		return '<CarLanguage {} {}>'.format(self.get_language_code(), self.name)
 
 	def get_language_code(self):
-		return self.language.code
+		return reference.language(self.language_id).code
+
+	@staticmethod
+	def name_startswith(prefix):
+		# A range instead of LIKE, so the condition can use an index on name.
+		return db.and_(CarLanguage.name >= prefix,
+					   CarLanguage.name < prefix + '\uffff')
+
+
+########################
+##### CHANGE FEED ######
+########################
+class Change(db.Model):
+	"""
+	The latest change of every user, car and user's car, read by sync jobs
+	with GET /api/changes. A new change of an entity replaces the previous
+	one with a greater id, so the feed has a row per entity and a deleted
+	entity leaves a tombstone. Changes of car names are changes of the car.
+	"""
+	# Ids are never reused, they are the cursor of the feed.
+	__table_args__ = (db.UniqueConstraint('entity', 'entity_id', 'related_id'),
+					  {'sqlite_autoincrement': True})
+	id = db.Column(db.Integer, primary_key=True)
+	# user, car or user_car
+	entity = db.Column(db.String(16), nullable=False)
+	entity_id = db.Column(db.Integer, nullable=False)
+	# Car id of a user's car, 0 for users and cars.
+	related_id = db.Column(db.Integer, default=0, nullable=False)
+	deleted = db.Column(db.Boolean, default=False, nullable=False)
+	timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+	@staticmethod
+	def record(connection, entity, ids, deleted=False):
+		"""
+		Replace changes of the entities with new ones, in bulk.
+		:param connection: connection or session of the transaction
+		:param ids: entity ids, or (user id, car id) of user's cars
+		"""
+		# Sorted, so concurrent transactions lock the rows in the same order.
+		rows = [{'b_entity': entity,
+				 'b_entity_id': id[0] if isinstance(id, tuple) else id,
+				 'b_related_id': id[1] if isinstance(id, tuple) else 0,
+				 'b_deleted': deleted,
+				 'b_timestamp': datetime.utcnow()} for id in sorted(set(ids))]
+		if not rows:
+			return
+		table = Change.__table__
+		values = {
+			'entity': db.bindparam('b_entity'),
+			'entity_id': db.bindparam('b_entity_id'),
+			'related_id': db.bindparam('b_related_id'),
+			'deleted': db.bindparam('b_deleted'),
+			'timestamp': db.bindparam('b_timestamp')
+		}
+		# An upsert, so concurrent changes of an entity don't conflict.
+		# The replaced row gets a new id to move past the cursors.
+		dialect = (getattr(connection, 'dialect', None) or
+				   connection.get_bind().dialect).name
+		if dialect == 'sqlite':
+			connection.execute(table.insert().prefix_with('OR REPLACE').values(values), rows)
+		elif dialect == 'postgresql':
+			insert = postgresql.insert(table).values(
+				id=db.text("nextval(pg_get_serial_sequence('change', 'id'))"), **values)
+			connection.execute(insert.on_conflict_do_update(
+				index_elements=['entity', 'entity_id', 'related_id'],
+				set_={'id': insert.excluded.id,
+					  'deleted': insert.excluded.deleted,
+					  'timestamp': insert.excluded.timestamp}), rows)
+		else:
+			connection.execute(table.delete().where(db.and_(
+				table.c.entity == db.bindparam('b_entity'),
+				table.c.entity_id == db.bindparam('b_entity_id'),
+				table.c.related_id == db.bindparam('b_related_id'))), rows)
+			connection.execute(table.insert().values(values), rows)
+
+	@staticmethod
+	def to_feed_dict(since, limit, lang_code='en', lag=0):
+		"""
+		Return changes after the since cursor, oldest first, with the current
+		data of changed users and cars loaded in two queries.
+		:param lag: seconds to commit a change. Ids are taken at insert time, a
+					transaction can commit a change after another one with
+					a greater id, so the feed stops before changes younger
+					than lag, which can be preceded by uncommitted ones.
+		"""
+		query = Change.query.filter(Change.id > since)
+		if lag:
+			horizon = datetime.utcnow() - timedelta(seconds=lag)
+			first_young = db.session.query(db.func.min(Change.id)) \
+				.filter(Change.id > since, Change.timestamp > horizon).scalar()
+			if first_young is not None:
+				query = query.filter(Change.id < first_young)
+		changes = query.order_by(Change.id).limit(limit + 1).all()
+		has_more = len(changes) > limit
+		changes = changes[:limit]
+		live = lambda entity: [change.entity_id for change in changes
+							   if change.entity == entity and not change.deleted]
+		users = {user.id: user for user in User.query.filter(User.id.in_(live('user')))} \
+			if live('user') else {}
+		cars = {car.id: car for car in Car.query.filter(Car.id.in_(live('car')))} \
+			if live('car') else {}
+		Car.load_names(list(cars.values()), lang_code)
+		items = []
+		for change in changes:
+			item = {
+				'cursor': change.id,
+				'entity': change.entity,
+				'deleted': change.deleted,
+				'timestamp': change.timestamp.isoformat() + 'Z'
+			}
+			if change.entity == 'user_car':
+				item['user_id'] = change.entity_id
+				item['car_id'] = change.related_id
+			else:
+				item['id'] = change.entity_id
+				obj = (users if change.entity == 'user' else cars).get(change.entity_id)
+				if obj is None:
+					# Deleted after the change was read.
+					item['deleted'] = True
+				elif not change.deleted:
+					item['data'] = obj.to_dict(include_email=True) \
+						if change.entity == 'user' else obj.to_dict(lang_code)
+			items.append(item)
+		next_since = changes[-1].id if changes else since
+		return {
+			'items': items,
+			'meta': {
+				'since': since,
+				'next_since': next_since,
+				'limit': limit,
+				'has_more': has_more
+			},
+			'_links': {
+				'self': url_for('api.get_changes', since=since, limit=limit),
+				'next': url_for('api.get_changes', since=next_since, limit=limit)
+			}
+		}
+
+
+# Full-text search index over car names.
+db.event.listen(CarLanguage.__table__, 'after_create', search.create_index)
+db.event.listen(CarLanguage.__table__, 'before_drop', search.drop_index)
+
+# Keep car_count and users_count counters in sync with the usercar table.
+# Both sides of the relationship receive the events, so each listener
+# updates only its own counter.
+@db.event.listens_for(User.cars, 'append')
+def user_car_appended(user, car, initiator):
+	change_counter(user, 'car_count', 1)
+	db.session.info.setdefault('links_changed', {})[(user, car)] = False
+
+@db.event.listens_for(User.cars, 'remove')
+def user_car_removed(user, car, initiator):
+	change_counter(user, 'car_count', -1)
+	db.session.info.setdefault('links_changed', {})[(user, car)] = True
+
+@db.event.listens_for(Car.users, 'append')
+def car_user_appended(car, user, initiator):
+	change_counter(car, 'users_count', 1)
+
+@db.event.listens_for(Car.users, 'remove')
+def car_user_removed(car, user, initiator):
+	change_counter(car, 'users_count', -1)
+
+def change_counter(obj, name, delta):
+	"""
+	Add delta to the counter of a new object, or of a stored one on flush
+	with an SQL expression, so concurrent updates don't overwrite it.
+	"""
+	if not db.inspect(obj).persistent:
+		setattr(obj, name, (getattr(obj, name) or 0) + delta)
+		return
+	counters = db.session.info.setdefault('counters_changed', {})
+	counters[(obj, name)] = counters.get((obj, name), 0) + delta
+
+@db.event.listens_for(db.session, 'before_flush')
+def update_counters(session, flush_context, instances):
+	for (obj, name), delta in session.info.pop('counters_changed', {}).items():
+		if delta and obj in session and obj not in session.deleted:
+			setattr(obj, name, getattr(type(obj), name) + delta)
+
+# Drop the cached token of a changed user, its role or token can be changed.
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, user):
+	if user.token:
+		token_cache.delete(user.token)
+
+# Record changes for the change feed.
+@db.event.listens_for(User, 'after_insert')
+@db.event.listens_for(Car, 'after_insert')
+def record_change(mapper, connection, target):
+	Change.record(connection, type(target).__name__.lower(), [target.id])
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(Car, 'after_update')
+def record_update(mapper, connection, target):
+	if versioned_changes(mapper, target):
+		record_change(mapper, connection, target)
+
+@db.event.listens_for(User, 'after_delete')
+@db.event.listens_for(Car, 'after_delete')
+def record_deletion(mapper, connection, target):
+	Change.record(connection, type(target).__name__.lower(), [target.id], deleted=True)
+
+@db.event.listens_for(db.session, 'after_flush')
+def record_link_changes(session, flush_context):
+	# Links have ids only after the flush of new users and cars.
+	links = session.info.pop('links_changed', {})
+	for deleted in (False, True):
+		Change.record(session, 'user_car', [(user.id, car.id) for (user, car), value
+											in links.items() if value is deleted], deleted)
+
+# Drop rendered rows of changed users and cars after commit.
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+@db.event.listens_for(Car, 'after_update')
+@db.event.listens_for(Car, 'after_delete')
+@db.event.listens_for(CarLanguage, 'after_insert')
+@db.event.listens_for(CarLanguage, 'after_update')
+@db.event.listens_for(CarLanguage, 'after_delete')
+def fragments_changed(mapper, connection, target):
+	if isinstance(target, CarLanguage):
+		entity = ('car', target.car_id)
+	else:
+		entity = (type(target).__name__.lower(), target.id)
+	db.object_session(target).info.setdefault('fragments_changed', set()).add(entity)
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_fragments(session):
+	fragment_cache.invalidate(session.info.pop('fragments_changed', None))
+
+# Reload the reference data after languages or roles were changed.
+@db.event.listens_for(Language, 'after_insert')
+@db.event.listens_for(Language, 'after_update')
+@db.event.listens_for(Language, 'after_delete')
+@db.event.listens_for(Role, 'after_insert')
+@db.event.listens_for(Role, 'after_update')
+@db.event.listens_for(Role, 'after_delete')
+def reference_changed(mapper, connection, target):
+	db.object_session(target).info['reference_changed'] = True
+
+@db.event.listens_for(db.session, 'after_commit')
+def reload_reference(session):
+	if session.info.pop('reference_changed', False):
+		reference.invalidate()
+		# Rows show language names and role dependent links.
+		fragment_cache.clear()
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_pending_changes(session):
+	session.info.pop('reference_changed', None)
+	session.info.pop('fragments_changed', None)
+	session.info.pop('links_changed', None)
+	session.info.pop('counters_changed', None)
+
+def versioned_changes(mapper, target):
+	"""Check if columns other than unversioned_columns of the target changed."""
+	unversioned = getattr(target, 'unversioned_columns', ())
+	state = db.inspect(target)
+	return any(state.attrs[prop.key].history.has_changes()
+			   for prop in mapper.column_attrs if prop.key not in unversioned)
+
+# Bump row versions.
+@db.event.listens_for(User, 'before_update')
+@db.event.listens_for(Car, 'before_update')
+def increment_version(mapper, connection, target):
+	if versioned_changes(mapper, target):
+		target.version = type(target).version + 1
 
+@db.event.listens_for(db.session, 'before_flush')
+def touch_cars_of_changed_names(session, flush_context, instances):
+	# Names are part of the car for clients, so a name change updates the car.
+	for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+		if isinstance(obj, CarLanguage):
+			car = obj.car
+			if car is not None and car in session and car not in session.deleted \
+					and not db.inspect(car).pending:
+				car.version = Car.version + 1
 
+@db.event.listens_for(db.session, 'before_flush')
+def update_counters_on_delete(session, flush_context, instances):
+	# Deleting a user or a car removes its usercar rows without
+	# collection events, so decrement the other side directly.
+	for obj in session.deleted:
+		if isinstance(obj, User):
+			car_ids = [id for id, in session.execute(db.select([usercar_table.c.car_id])
+						.where(usercar_table.c.user_id == obj.id))]
+			if car_ids:
+				session.execute(Car.__table__.update()
+					.where(Car.id.in_(car_ids))
+					.values(users_count=Car.users_count - 1,
+							version=Car.version + 1))
+			Change.record(session, 'car', car_ids)
+			Change.record(session, 'user_car', [(obj.id, id) for id in car_ids],
+						  deleted=True)
+		elif isinstance(obj, Car):
+			user_ids = [id for id, in session.execute(db.select([usercar_table.c.user_id])
+						 .where(usercar_table.c.car_id == obj.id))]
+			if user_ids:
+				session.execute(User.__table__.update()
+					.where(User.id.in_(user_ids))
+					.values(car_count=User.car_count - 1,
+							version=User.version + 1))
+			Change.record(session, 'user', user_ids)
+			Change.record(session, 'user_car', [(id, obj.id) for id in user_ids],
+						  deleted=True)
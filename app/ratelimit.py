@@ -0,0 +1,191 @@
+import math
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+from app.backends import load_backend, redis_client
+from app.metrics import metrics
+
+
+# Seconds of the period names in limits like '10/minute'.
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimitExceeded(TooManyRequests):
+	"""429 with the seconds until the bucket has a token again."""
+
+	def __init__(self, retry_after, description=None):
+		super(RateLimitExceeded, self).__init__(description)
+		self.retry_after = retry_after
+
+
+class MemoryBackend(object):
+	"""
+	Buckets of a process, every worker limits on its own. Up to
+	RATELIMIT_SIZE least recently used buckets are kept.
+	"""
+
+	def __init__(self, app):
+		self.maxsize = app.config['RATELIMIT_SIZE']
+		self._buckets = OrderedDict()
+		self._lock = threading.Lock()
+
+	def take(self, key, rate, burst):
+		"""
+		Take a token from the bucket, which gains rate tokens a second
+		up to burst. Return (taken, tokens left).
+		"""
+		now = monotonic()
+		with self._lock:
+			tokens, updated = self._buckets.get(key, (burst, now))
+			tokens = min(burst, tokens + (now - updated) * rate)
+			taken = tokens >= 1
+			if taken:
+				tokens -= 1
+			self._buckets[key] = (tokens, now)
+			self._buckets.move_to_end(key)
+			while len(self._buckets) > self.maxsize:
+				self._buckets.popitem(last=False)
+		return taken, tokens
+
+	def clear(self):
+		with self._lock:
+			self._buckets.clear()
+
+
+# Refill and take in one step, so workers don't race on a bucket.
+# Numbers are returned as strings, Lua numbers are truncated to integers.
+TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local taken = 0
+if tokens >= 1 then
+	tokens = tokens - 1
+	taken = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {taken, tostring(tokens)}
+"""
+
+
+class RedisBackend(object):
+	"""Buckets shared by all workers in Redis at RATELIMIT_URL."""
+
+	def __init__(self, app):
+		self.client = redis_client(app.config['RATELIMIT_URL'], 'RATELIMIT_BACKEND redis')
+		self.script = self.client.register_script(TAKE_SCRIPT)
+		self.prefix = 'ratelimit:'
+
+	def take(self, key, rate, burst):
+		taken, tokens = self.script(keys=[self.prefix + key], args=[rate, burst, time()])
+		return bool(taken), float(tokens)
+
+	def clear(self):
+		keys = list(self.client.scan_iter(self.prefix + '*'))
+		if keys:
+			self.client.delete(*keys)
+
+
+BACKENDS = {'memory': MemoryBackend, 'redis': RedisBackend}
+
+
+def parse_limit(limit):
+	"""Return (count, seconds) of a limit like '10/minute'."""
+	try:
+		count, period = limit.split('/')
+		return int(count), PERIODS[period.strip()]
+	except (ValueError, KeyError):
+		raise RuntimeError('Bad rate limit {}, expected like 10/minute'.format(limit))
+
+
+class Policy(object):
+	"""
+	Token bucket of an endpoint or blueprint.
+	:param limit: sustained rate like '10/minute'
+	:param burst: requests allowed at once, by default the count of the limit
+	:param key: 'ip' for a bucket per client address, 'token' for a bucket
+				per user of a valid API token (per address otherwise)
+	:param methods: limited methods, by default all of them
+	"""
+
+	def __init__(self, name, limit, burst=None, key='ip', methods=None):
+		if key not in ('ip', 'token'):
+			raise RuntimeError('Rate limit {} has unknown key {}'.format(name, key))
+		count, seconds = parse_limit(limit)
+		self.name = name
+		self.rate = count / seconds
+		self.burst = burst or count
+		self.key = key
+		self.methods = set(methods) if methods else None
+
+	def applies(self, method):
+		return self.methods is None or method in self.methods
+
+	def bucket(self):
+		"""Return the bucket key of the current request."""
+		from app.models import User
+		auth = request.headers.get('Authorization', '')
+		# Random tokens must not get buckets of their own.
+		principal = User.token_principal(auth[7:]) \
+			if self.key == 'token' and auth.startswith('Bearer ') else None
+		if principal is not None:
+			client = 'user:{}'.format(principal['id'])
+		else:
+			client = 'ip:{}'.format(request.remote_addr)
+		return '{}:{}'.format(self.name, client)
+
+
+class RateLimiter(object):
+	"""
+	Limit requests of endpoints or blueprints in RATELIMIT_POLICIES with
+	token buckets of RATELIMIT_BACKEND: memory, redis (shared by workers,
+	at RATELIMIT_URL), a 'module:Class' path or empty to turn limits off.
+	Requests are checked before the view, so a rejected one doesn't hash
+	a password or send an email.
+	"""
+
+	def __init__(self, app=None):
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		name = app.config['RATELIMIT_BACKEND']
+		app.extensions['ratelimit'] = load_backend(name, BACKENDS, 'RATELIMIT_BACKEND')(app) \
+			if name else None
+		app.extensions['ratelimit_policies'] = {
+			rule: Policy(rule, **options)
+			for rule, options in app.config['RATELIMIT_POLICIES'].items()}
+		if name:
+			app.before_request(self._before_request)
+
+	@property
+	def backend(self):
+		return current_app.extensions.get('ratelimit')
+
+	@staticmethod
+	def policy(endpoint):
+		"""Return the policy of the endpoint, then of its blueprint, or None."""
+		policies = current_app.extensions['ratelimit_policies']
+		if endpoint is None:
+			return None
+		if endpoint in policies:
+			return policies[endpoint]
+		return policies.get(endpoint.rpartition('.')[0])
+
+	def _before_request(self):
+		policy = self.policy(request.endpoint)
+		if policy is None or not policy.applies(request.method):
+			return
+		taken, tokens = self.backend.take(policy.bucket(), policy.rate, policy.burst)
+		if not taken:
+			metrics.rate_limited.inc(policy=policy.name)
+			raise RateLimitExceeded(max(1, int(math.ceil((1 - tokens) / policy.rate))),
+									'Too many requests, try again later.')
+
+
+rate_limiter = RateLimiter()
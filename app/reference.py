@@ -0,0 +1,92 @@
+import threading
+from time import monotonic
+from flask import current_app
+from sqlalchemy.orm import Session
+from app import db
+
+
+class ReferenceData(object):
+	"""
+	In-memory registry of Language and Role rows, which almost never change.
+	Rows are loaded once per app and dropped when a language or a role is
+	committed. Rows committed by other processes, e.g. by `flask deploy`,
+	are seen after REFERENCE_RELOAD_INTERVAL seconds, when the rows are
+	reloaded. The objects are detached from any session: read them and
+	assign their ids, never the objects, to other models.
+	"""
+
+	def __init__(self, app=None):
+		self._lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		app.extensions['reference_data'] = None
+		app.before_first_request(self._data)
+
+	def _data(self):
+		extensions = current_app.extensions
+		data = extensions.get('reference_data')
+		if self._stale(data):
+			with self._lock:
+				data = extensions.get('reference_data')
+				if self._stale(data):
+					data = self._load()
+					extensions['reference_data'] = data
+		return data
+
+	@staticmethod
+	def _stale(data):
+		return data is None or \
+			monotonic() - data['loaded'] >= current_app.config['REFERENCE_RELOAD_INTERVAL']
+
+	def _load(self):
+		from app.models import Language, Role
+		session = Session(bind=db.engine)
+		try:
+			languages = session.query(Language).order_by(Language.id).all()
+			roles = session.query(Role).order_by(Role.id).all()
+			session.expunge_all()
+		finally:
+			session.close()
+		return {
+			'loaded': monotonic(),
+			'languages': languages,
+			'language_ids': {lang.id: lang for lang in languages},
+			'language_codes': {lang.code: lang for lang in languages},
+			'roles': roles,
+			'role_ids': {role.id: role for role in roles},
+			'role_names': {role.name: role for role in roles}
+		}
+
+	def _get(self, index, key):
+		return self._data()[index].get(key)
+
+	def invalidate(self):
+		current_app.extensions['reference_data'] = None
+
+	def languages(self):
+		return self._data()['languages']
+
+	def language(self, id):
+		return self._get('language_ids', id)
+
+	def language_by_code(self, code):
+		return self._get('language_codes', code)
+
+	def roles(self):
+		return self._data()['roles']
+
+	def role(self, id):
+		return self._get('role_ids', id)
+
+	def role_by_name(self, name):
+		return self._get('role_names', name)
+
+	def default_role(self):
+		for role in self.roles():
+			if role.default:
+				return role
+
+
+reference = ReferenceData()
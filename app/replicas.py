@@ -0,0 +1,137 @@
+import random
+from contextlib import contextmanager
+from flask import current_app, request
+from flask_login import current_user
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+from app.backends import redis_client
+from app.cache import TTLCache
+
+
+# Requests which can read from a replica.
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingSession(SignallingSession):
+	"""
+	Session which sends SELECTs to the replica bind named in
+	info['replica']. Other statements, flushes and everything after
+	the first write go to the primary.
+	"""
+
+	def __init__(self, db, **options):
+		self.db = db
+		super(RoutingSession, self).__init__(db, **options)
+
+	def get_bind(self, mapper=None, clause=None):
+		if self._flushing or isinstance(clause, UpdateBase):
+			# Read your own writes until the end of the request.
+			self.info['wrote'] = True
+		else:
+			replica = self.info.get('replica')
+			bind_key = mapper.persist_selectable.info.get('bind_key') \
+				if mapper is not None else None
+			if replica is not None and not self.info.get('wrote') \
+					and bind_key is None and isinstance(clause, Select):
+				return self.db.get_engine(self.app, bind=replica)
+		return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+	def create_session(self, options):
+		return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class RedisPins(object):
+	"""Clients pinned to the primary, shared by all workers in Redis."""
+
+	def __init__(self, url):
+		self.client = redis_client(url, 'DATABASE_REPLICA_PIN_URL')
+		self.prefix = 'primary:'
+
+	def get(self, key):
+		return self.client.get(self.prefix + key)
+
+	def set(self, key, value, ttl):
+		self.client.set(self.prefix + key, value, ex=ttl)
+
+
+class ReplicaRouting(object):
+	"""
+	Add DATABASE_REPLICA_URLS as binds replica1, replica2... and route safe
+	requests of endpoints or blueprints set to 'replica' in
+	DATABASE_READ_ROUTES to a random replica. A client which wrote reads
+	from the primary for DATABASE_REPLICA_LAG seconds. Clients are users
+	of API tokens or logins, or addresses, and are pinned on the server:
+	in Redis at DATABASE_REPLICA_PIN_URL or in the worker's memory.
+	"""
+
+	def __init__(self, app=None):
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		urls = app.config['DATABASE_REPLICA_URLS']
+		binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+		for i, url in enumerate(urls, 1):
+			binds['replica{}'.format(i)] = url
+		app.config['SQLALCHEMY_BINDS'] = binds or None
+		app.extensions['replicas'] = ['replica{}'.format(i) for i in range(1, len(urls) + 1)]
+		lag = app.config['DATABASE_REPLICA_LAG']
+		app.extensions['replica_pins'] = RedisPins(app.config['DATABASE_REPLICA_PIN_URL']) \
+			if app.config['DATABASE_REPLICA_PIN_URL'] else TTLCache(100000, lag)
+		if urls:
+			app.before_request(self._before_request)
+			app.after_request(self._after_request)
+
+	def _before_request(self):
+		from app import db
+		if request.method in SAFE_METHODS and self.route(request.endpoint) == 'replica' \
+				and not current_app.extensions['replica_pins'].get(self.client()):
+			db.session.info['replica'] = random.choice(current_app.extensions['replicas'])
+
+	def _after_request(self, response):
+		from app import db
+		if db.session.info.get('wrote'):
+			current_app.extensions['replica_pins'].set(
+				self.client(), 1, current_app.config['DATABASE_REPLICA_LAG'])
+		return response
+
+	@staticmethod
+	def client():
+		"""Return the user of a valid API token or of the login, or the address."""
+		from app.models import User
+		auth = request.headers.get('Authorization', '')
+		principal = User.token_principal(auth[7:]) if auth.startswith('Bearer ') else None
+		if principal is not None:
+			return 'user:{}'.format(principal['id'])
+		if current_user.is_authenticated:
+			return 'user:{}'.format(current_user.id)
+		return 'ip:{}'.format(request.remote_addr)
+
+	@staticmethod
+	def route(endpoint):
+		"""Return 'replica' or 'primary' for the endpoint, then for its blueprint."""
+		routes = current_app.config['DATABASE_READ_ROUTES']
+		if endpoint is None:
+			return 'primary'
+		if endpoint in routes:
+			return routes[endpoint]
+		return routes.get(endpoint.rpartition('.')[0], 'primary')
+
+
+replica_routing = ReplicaRouting()
+
+
+@contextmanager
+def use_primary():
+	"""Read from the primary inside the block, e.g. a row which can lag."""
+	from app import db
+	replica = db.session.info.pop('replica', None)
+	try:
+		yield
+	finally:
+		if replica is not None:
+			db.session.info['replica'] = replica
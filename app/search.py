@@ -0,0 +1,130 @@
+import re
+from app import db
+
+
+# Names of database objects owned by the search index, migrations skip them.
+SEARCH_OBJECTS = ('car_name_fts', 'ix_car_language_name_trgm')
+
+# SQLite: an FTS5 table with one row per car, rowid is the car id and
+# names holds the car's names in every language. Triggers on car_language
+# rebuild the car's row, so ORM and bulk writes keep the index in sync.
+SQLITE_DDL = [
+	"CREATE VIRTUAL TABLE IF NOT EXISTS car_name_fts USING fts5("
+	"names, tokenize='unicode61 remove_diacritics 2')",
+	"CREATE TRIGGER IF NOT EXISTS car_language_fts_insert "
+	"AFTER INSERT ON car_language BEGIN "
+	"DELETE FROM car_name_fts WHERE rowid = new.car_id; "
+	"INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+	"FROM car_language WHERE car_id = new.car_id GROUP BY car_id; "
+	"END",
+	"CREATE TRIGGER IF NOT EXISTS car_language_fts_update "
+	"AFTER UPDATE ON car_language BEGIN "
+	"DELETE FROM car_name_fts WHERE rowid IN (old.car_id, new.car_id); "
+	"INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+	"FROM car_language WHERE car_id IN (old.car_id, new.car_id) GROUP BY car_id; "
+	"END",
+	"CREATE TRIGGER IF NOT EXISTS car_language_fts_delete "
+	"AFTER DELETE ON car_language BEGIN "
+	"DELETE FROM car_name_fts WHERE rowid = old.car_id; "
+	"INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+	"FROM car_language WHERE car_id = old.car_id GROUP BY car_id; "
+	"END"
+]
+
+SQLITE_REBUILD = [
+	"DELETE FROM car_name_fts",
+	"INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+	"FROM car_language GROUP BY car_id"
+]
+
+# PostgreSQL: a trigram index on the names, maintained by the database.
+POSTGRESQL_DDL = [
+	"CREATE EXTENSION IF NOT EXISTS pg_trgm",
+	"CREATE INDEX IF NOT EXISTS ix_car_language_name_trgm "
+	"ON car_language USING gin (name gin_trgm_ops)"
+]
+
+
+def create_index(target, connection, **kwargs):
+	"""Create the search index together with the car_language table."""
+	if connection.dialect.name == 'sqlite':
+		for statement in SQLITE_DDL:
+			connection.execute(statement)
+	elif connection.dialect.name == 'postgresql':
+		for statement in POSTGRESQL_DDL:
+			connection.execute(statement)
+
+def drop_index(target, connection, **kwargs):
+	# Triggers and the trigram index are dropped with the table.
+	if connection.dialect.name == 'sqlite':
+		connection.execute('DROP TABLE IF EXISTS car_name_fts')
+
+def rebuild_index():
+	"""Fill the search index from car_language again."""
+	dialect = db.engine.dialect.name
+	if dialect == 'sqlite':
+		for statement in SQLITE_REBUILD:
+			db.session.execute(statement)
+	elif dialect == 'postgresql':
+		db.session.execute('REINDEX INDEX ix_car_language_name_trgm')
+	db.session.commit()
+
+def search_cars(text, limit=20):
+	"""
+	Find cars which names in any language match the text.
+	Return the cars, best matches first.
+	:param text: words to search, the last one can be incomplete
+	:param limit: max number of cars
+	"""
+	text = (text or '').strip()
+	if not text or limit <= 0:
+		return []
+	dialect = db.engine.dialect.name
+	if dialect == 'sqlite':
+		ids = _sqlite_search(text, limit)
+	elif dialect == 'postgresql':
+		ids = _postgresql_search(text, limit)
+	else:
+		ids = _like_search(text, limit)
+	return _load_cars(ids)
+
+def _sqlite_search(text, limit):
+	# Every word is quoted, so the user can't write FTS5 query syntax.
+	words = re.findall(r'\w+', text)
+	if not words:
+		return []
+	match = ' '.join('"{}"*'.format(word) for word in words)
+	rows = db.session.execute(
+		'SELECT rowid FROM car_name_fts WHERE car_name_fts MATCH :match '
+		'ORDER BY rank LIMIT :limit', {'match': match, 'limit': limit})
+	return [row[0] for row in rows]
+
+def _postgresql_search(text, limit):
+	return [car_id for car_id, score in _postgresql_query(text, limit)]
+
+def _postgresql_query(text, limit):
+	from app.models import CarLanguage
+	score = db.func.max(db.func.similarity(CarLanguage.name, text))
+	# The pg_trgm operator is %, psycopg2 needs it escaped as %%.
+	return db.session.query(CarLanguage.car_id, score) \
+		.filter(db.or_(CarLanguage.name.op('%%')(text),
+					   CarLanguage.name.ilike(_contains(text)))) \
+		.group_by(CarLanguage.car_id) \
+		.order_by(score.desc(), CarLanguage.car_id).limit(limit)
+
+def _like_search(text, limit):
+	from app.models import CarLanguage
+	rows = db.session.query(CarLanguage.car_id).distinct() \
+		.filter(CarLanguage.name.ilike(_contains(text), escape='\\')) \
+		.order_by(CarLanguage.car_id).limit(limit)
+	return [car_id for car_id, in rows]
+
+def _contains(text):
+	return '%{}%'.format(re.sub(r'([\\%_])', r'\\\1', text))
+
+def _load_cars(ids):
+	from app.models import Car
+	if not ids:
+		return []
+	cars = {car.id: car for car in Car.query.filter(Car.id.in_(ids))}
+	return [cars[id] for id in ids if id in cars]
@@ -0,0 +1,151 @@
+import re
+import threading
+from collections import Counter
+from time import perf_counter
+from flask import current_app, g, request, has_request_context
+from sqlalchemy.engine import Engine
+from app import db
+
+
+class QueryBudgetExceeded(Exception):
+	pass
+
+
+class RequestQueries(object):
+	"""Queries made while handling one request."""
+
+	def __init__(self):
+		self.count = 0
+		self.time = 0.0
+		self.started = perf_counter()
+		self.fingerprints = Counter()
+
+	def record(self, statement, duration):
+		self.count += 1
+		self.time += duration
+		self.fingerprints[fingerprint(statement)] += 1
+
+	def repeated(self):
+		"""Return [(fingerprint, count)] of statements made more than once."""
+		return [(statement, count) for statement, count
+				in self.fingerprints.most_common() if count > 1]
+
+
+class SQLStats(object):
+	"""
+	Count queries and SQL time of every request and keep totals per endpoint.
+	Statements repeated within a request are grouped by fingerprint, they
+	are usually lazy loads in a loop (N+1 queries).
+	"""
+
+	def __init__(self, app=None):
+		self._lock = threading.Lock()
+		self.endpoints = {}
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.endpoints = {}
+		app.extensions['sql_stats'] = self
+		app.before_request(self._before_request)
+		app.after_request(self._after_request)
+
+	def _before_request(self):
+		g.sql_queries = RequestQueries()
+
+	def _after_request(self, response):
+		queries = g.pop('sql_queries', None)
+		if queries is None:
+			return response
+		endpoint = request.endpoint or 'unknown'
+		self._add(endpoint, queries)
+		config = current_app.config
+		if config['SQL_TIMING_HEADERS'] or current_app.debug or current_app.testing:
+			response.headers['X-Query-Count'] = str(queries.count)
+			response.headers['Server-Timing'] = \
+				'sql;dur={:.1f};desc="{} queries", total;dur={:.1f}'.format(
+					queries.time * 1000, queries.count,
+					(perf_counter() - queries.started) * 1000)
+		budget = config['SQL_QUERY_BUDGETS'].get(endpoint, config['SQL_QUERY_BUDGET'])
+		if queries.count > budget:
+			message = '{} made {} queries, the budget is {}. Repeated: {}'.format(
+				endpoint, queries.count, budget,
+				'; '.join('{} x{}'.format(statement, count)
+						  for statement, count in queries.repeated()[:3]) or 'none')
+			if config['SQL_QUERY_BUDGET_FAIL']:
+				raise QueryBudgetExceeded(message)
+			current_app.logger.warning(message)
+		return response
+
+	def _add(self, endpoint, queries):
+		with self._lock:
+			stats = self.endpoints.get(endpoint)
+			if stats is None:
+				stats = self.endpoints[endpoint] = {
+					'requests': 0, 'queries': 0, 'max_queries': 0,
+					'sql_time': 0.0, 'repeated': Counter()}
+			stats['requests'] += 1
+			stats['queries'] += queries.count
+			stats['max_queries'] = max(stats['max_queries'], queries.count)
+			stats['sql_time'] += queries.time
+			for statement, count in queries.repeated():
+				stats['repeated'][statement] += count
+
+	def report(self, limit=10):
+		"""
+		Return the endpoints with the most queries per request first.
+		Each item is a dict with the endpoint, requests, avg_queries,
+		max_queries, avg_sql_time in ms and the most repeated statement.
+		"""
+		with self._lock:
+			items = list(self.endpoints.items())
+		report = []
+		for endpoint, stats in items:
+			repeated = stats['repeated'].most_common(1)
+			report.append({
+				'endpoint': endpoint,
+				'requests': stats['requests'],
+				'avg_queries': stats['queries'] / stats['requests'],
+				'max_queries': stats['max_queries'],
+				'avg_sql_time': stats['sql_time'] * 1000 / stats['requests'],
+				'repeated': repeated[0] if repeated else None
+			})
+		report.sort(key=lambda item: (item['avg_queries'], item['avg_sql_time']),
+					reverse=True)
+		return report[:limit]
+
+	def reset(self):
+		with self._lock:
+			self.endpoints = {}
+
+
+sql_stats = SQLStats()
+
+
+def fingerprint(statement):
+	# Same statement with a different number of IN parameters.
+	statement = re.sub(r'\((?:\s*\?\s*,)+\s*\?\s*\)', '(?)', statement)
+	statement = re.sub(r'\((?:\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)', '(?)', statement)
+	return ' '.join(statement.split())
+
+
+# Listen to every engine, queries outside of requests are not recorded.
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	conn.info.setdefault('query_started', []).append(perf_counter())
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	started = conn.info['query_started'].pop()
+	if has_request_context():
+		queries = g.get('sql_queries')
+		if queries is not None:
+			queries.record(statement, perf_counter() - started)
+
+@db.event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+	# after_cursor_execute isn't called for a failed statement.
+	started = context.connection.info.get('query_started') \
+		if context.connection is not None else None
+	if started:
+		started.pop()
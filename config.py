@@ -1,5 +1,6 @@
 import os
 from dotenv import load_dotenv
+from sqlalchemy.pool import QueuePool
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -8,11 +9,74 @@ load_dotenv(os.path.join(basedir, '.env'))
 class Config(object):
 	# App settings.
 	SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
+	# Number of proxies in front of the app, which X-Forwarded-For and
+	# X-Forwarded-Proto are trusted from. Heroku dynos run behind one router.
+	PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or
+						  (1 if 'DYNO' in os.environ else 0))
 
 	# Database settings.
 	SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
 		'sqlite:///' + os.path.join(basedir, 'app.db')
 	SQLALCHEMY_TRACK_MODIFICATIONS =False
+	# Languages and roles are kept in memory and reloaded every
+	# REFERENCE_RELOAD_INTERVAL seconds, e.g. after `flask deploy`.
+	REFERENCE_RELOAD_INTERVAL = int(os.environ.get('REFERENCE_RELOAD_INTERVAL') or 30)
+	# Read replicas of the primary, comma-separated URLs. GET requests of
+	# endpoints or blueprints routed to 'replica' read from a random one.
+	# A client which wrote reads from the primary for DATABASE_REPLICA_LAG
+	# seconds, writes always go to the primary.
+	DATABASE_REPLICA_URLS = [url for url in
+							 (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
+	DATABASE_REPLICA_LAG = int(os.environ.get('DATABASE_REPLICA_LAG') or 5)
+	# Redis URL to pin clients for all workers, by default every worker
+	# pins in its memory.
+	DATABASE_REPLICA_PIN_URL = os.environ.get('DATABASE_REPLICA_PIN_URL')
+	DATABASE_READ_ROUTES = {
+		'api': 'replica',
+		'admin.users': 'replica',
+		'admin.cars': 'replica'
+	}
+	# Engine options and connect-time pragmas, DATABASE_PROFILE picks a
+	# profile, by default sqlite-dev for SQLite and postgres-pooled otherwise.
+	# SQLALCHEMY_ENGINE_OPTIONS override options of the profile.
+	DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE')
+	ENGINE_PROFILES = {
+		# Engine defaults: a connection per checkout, a rollback journal.
+		'sqlite-dev': {},
+		# Several workers on one SQLite file: readers don't wait for a writer
+		# in WAL mode and writers wait for the lock instead of failing.
+		'sqlite-concurrent': {
+			'engine_options': {
+				'poolclass': QueuePool,
+				'pool_size': 5,
+				'max_overflow': 5,
+				'connect_args': {'check_same_thread': False, 'timeout': 15}
+			},
+			'pragmas': {
+				'journal_mode': 'WAL',
+				'synchronous': 'NORMAL',
+				'busy_timeout': 15000,
+				'mmap_size': 256 * 1024 * 1024,
+				'cache_size': -16000,
+				'temp_store': 'MEMORY'
+			}
+		},
+		'postgres-pooled': {
+			'engine_options': {
+				'pool_size': 10,
+				'max_overflow': 20,
+				'pool_timeout': 10,
+				'pool_recycle': 1800,
+				'pool_pre_ping': True
+			}
+		}
+	}
+
+	# Password hashing, see werkzeug.security.generate_password_hash().
+	# Stored hashes made with other settings are updated on the next login.
+	PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+		'pbkdf2:sha256:150000'
+	PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
 
 	# Mail settings
 	MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'localhost'
@@ -21,9 +85,70 @@ class Config(object):
 	MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
 	MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
 	ADMINS = ['admin@ex.com']
+	# Emails are sent by MAIL_WORKERS threads, each one sends up to
+	# MAIL_BATCH_SIZE queued emails over one SMTP connection.
+	MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+	MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+	MAIL_QUEUE_TIMEOUT = 5
+	MAIL_BATCH_SIZE = 20
+	MAIL_MAX_RETRIES = 3
+	MAIL_RETRY_DELAY = 1.0
+
+	# API settings.
+	# Verified tokens are cached per process, a revoked token can still
+	# be accepted by other workers for up to TOKEN_CACHE_TTL seconds.
+	TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+	TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+	# /api/changes returns changes older than CHANGE_FEED_LAG seconds, a
+	# transaction writing changes must commit within it or they can be
+	# skipped by the cursor.
+	CHANGE_FEED_LAG = int(os.environ.get('CHANGE_FEED_LAG') or 10)
+
+	# SQL instrumentation.
+	# Queries of every request are counted. X-Query-Count and Server-Timing
+	# headers are sent in debug and testing modes or with SQL_TIMING_HEADERS.
+	SQL_TIMING_HEADERS = os.environ.get('SQL_TIMING_HEADERS') is not None
+	# A request making more queries logs a warning, or fails with
+	# SQL_QUERY_BUDGET_FAIL. SQL_QUERY_BUDGETS overrides it per endpoint.
+	SQL_QUERY_BUDGET = int(os.environ.get('SQL_QUERY_BUDGET') or 15)
+	SQL_QUERY_BUDGETS = {}
+	SQL_QUERY_BUDGET_FAIL = False
+
+	# Metrics in the Prometheus text format at /metrics.
+	# If METRICS_TOKEN is set, scrapes must send it as a Bearer token.
+	METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+	# Rate limits.
+	# Token buckets of RATELIMIT_BACKEND: memory (per worker, up to
+	# RATELIMIT_SIZE buckets), redis (shared by workers, at RATELIMIT_URL),
+	# a 'module:Class' path or empty to turn limits off. A policy of an
+	# endpoint or a blueprint allows 'limit' requests per period with bursts
+	# of 'burst', per client address ('ip') or per user of a valid API token
+	# ('token').
+	RATELIMIT_BACKEND = os.environ.get('RATELIMIT_BACKEND', 'memory')
+	RATELIMIT_URL = os.environ.get('RATELIMIT_URL') or 'redis://localhost:6379/1'
+	RATELIMIT_SIZE = int(os.environ.get('RATELIMIT_SIZE') or 100000)
+	RATELIMIT_POLICIES = {
+		'api': {'limit': '20/second', 'burst': 100, 'key': 'token'},
+		# Every call hashes a password.
+		'api.get_token': {'limit': '10/minute', 'key': 'ip'},
+		'api.create_user': {'limit': '5/minute', 'key': 'ip'},
+		'auth.login': {'limit': '10/minute', 'key': 'ip', 'methods': ['POST']},
+		# Every call sends an email.
+		'auth.reset_password_request': {'limit': '5/hour', 'burst': 3, 'key': 'ip',
+										'methods': ['POST']}
+	}
 
 	# Frontside settings.
 	POSTS_PER_PAGE = 10
+	SEARCH_RESULTS_LIMIT = 50
+	# Rendered list rows are cached by FRAGMENT_CACHE_BACKEND: memory, redis
+	# (shared by workers, at FRAGMENT_CACHE_URL), a 'module:Class' path or
+	# empty to render every row.
+	FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'memory')
+	FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL') or 'redis://localhost:6379/0'
+	FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+	FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 3600)
 
 	# Backside settings.
 	ADMIN_LOCKED = os.environ.get('ADMIN_LOCKED') or True
\ No newline at end of file
@@ -0,0 +1,24 @@
+# Gunicorn settings, read from the working directory by `gunicorn carrent:app`.
+import multiprocessing
+import os
+
+
+# API reads spend most of their time waiting for the database, so every
+# worker serves several requests with threads instead of one at a time.
+# Keep threads below the pool size plus overflow of DATABASE_PROFILE,
+# 30 for postgres-pooled, or requests wait for a connection.
+workers = int(os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS') or 8)
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)
+keepalive = 5
+
+
+def post_fork(server, worker):
+	# With preload_app the engine is created in the master, connections
+	# must not be shared with the forked workers.
+	if server.cfg.preload_app:
+		from app import db
+		from carrent import app
+		with app.app_context():
+			db.engine.dispose()
@@ -26,6 +26,7 @@ config.set_main_option(
     'sqlalchemy.url', current_app.config.get(
         'SQLALCHEMY_DATABASE_URI').replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
+from app.search import SEARCH_OBJECTS
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -72,6 +73,10 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # the search index is created by app.search, not by the models
+    def include_object(object, name, type_, reflected, compare_to):
+        return not (reflected and name and name.startswith(SEARCH_OBJECTS))
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix='sqlalchemy.',
@@ -83,6 +88,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,73 @@
+"""add car name search index
+
+Revision ID: 6ff989e11bf5
+Revises: e2c9c9b90e8f
+Create Date: 2026-10-18 19:23:34.783327
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6ff989e11bf5'
+down_revision = 'e2c9c9b90e8f'
+branch_labels = None
+depends_on = None
+
+
+# Copy of the search DDL in app/search.py at this revision.
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE car_name_fts USING fts5("
+    "names, tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER car_language_fts_insert "
+    "AFTER INSERT ON car_language BEGIN "
+    "DELETE FROM car_name_fts WHERE rowid = new.car_id; "
+    "INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+    "FROM car_language WHERE car_id = new.car_id GROUP BY car_id; "
+    "END",
+    "CREATE TRIGGER car_language_fts_update "
+    "AFTER UPDATE ON car_language BEGIN "
+    "DELETE FROM car_name_fts WHERE rowid IN (old.car_id, new.car_id); "
+    "INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+    "FROM car_language WHERE car_id IN (old.car_id, new.car_id) GROUP BY car_id; "
+    "END",
+    "CREATE TRIGGER car_language_fts_delete "
+    "AFTER DELETE ON car_language BEGIN "
+    "DELETE FROM car_name_fts WHERE rowid = old.car_id; "
+    "INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+    "FROM car_language WHERE car_id = old.car_id GROUP BY car_id; "
+    "END",
+    "INSERT INTO car_name_fts(rowid, names) SELECT car_id, group_concat(name, ' ') "
+    "FROM car_language GROUP BY car_id"
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER car_language_fts_insert",
+    "DROP TRIGGER car_language_fts_update",
+    "DROP TRIGGER car_language_fts_delete",
+    "DROP TABLE car_name_fts"
+]
+
+POSTGRESQL_UPGRADE = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX ix_car_language_name_trgm "
+    "ON car_language USING gin (name gin_trgm_ops)"
+]
+
+POSTGRESQL_DOWNGRADE = [
+    "DROP INDEX ix_car_language_name_trgm"
+]
+
+
+def run(statements):
+    for statement in statements.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+
+def upgrade():
+    run({'sqlite': SQLITE_UPGRADE, 'postgresql': POSTGRESQL_UPGRADE})
+
+
+def downgrade():
+    run({'sqlite': SQLITE_DOWNGRADE, 'postgresql': POSTGRESQL_DOWNGRADE})
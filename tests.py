@@ -1,13 +1,51 @@
 #!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import threading
 import unittest
-from app import create_app, db
-from app.models import User
+import base64
+import io
+import json
+from contextlib import redirect_stdout, redirect_stderr
+from datetime import datetime
+from smtplib import SMTPRecipientsRefused
+from flask import g
+from flask_login import login_user
+from flask_mail import email_dispatched
+from sqlalchemy import event, create_engine
+from sqlalchemy.dialects.postgresql import psycopg2 as postgresql_psycopg2
+from app import create_app, db, token_cache, mail
+from app.email import send_email, dispatcher
+from app import fake
+from app.reference import reference
+from app.search import search_cars, rebuild_index, _postgresql_query
+from app.export import export
+from app.importer import import_cars
+from app.metrics import metrics, Counter, Histogram, MeasuredQueuePool
+from app.database import engine_options, pool_stats
+from app.fragments import fragment_cache
+from app.replicas import replica_routing
+from app.ratelimit import rate_limiter, MemoryBackend, Policy
+from app.bench import percentile, compare_results, PooledWSGIServer, load_test, \
+	bench_database_ready, seed_database
+from app.sqlstats import sql_stats, fingerprint, QueryBudgetExceeded
+from app.models import User, Role, Language, Car, CarLanguage, Change, Permission
 from config import Config
 
 
+class BrokenBackend(object):
+	def __getattr__(self, name):
+		def fail(*args):
+			raise ConnectionError('Cache is down')
+		return fail
+
+
 class TestConfig(Config):
 	TESTING = True
 	SQLALCHEMY_DATABASE_URI = 'sqlite://'
+	PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+	SQL_QUERY_BUDGET_FAIL = True
 
 
 class UserModelCase(unittest.TestCase):
@@ -28,6 +66,820 @@ class UserModelCase(unittest.TestCase):
 		self.assertFalse(u.check_password('dog'))
 		self.assertTrue(u.check_password('cat'))
 
+	def test_password_rehash(self):
+		u = User(username='susan')
+		u.set_password('cat')
+		self.assertFalse(u.password_needs_rehash())
+		self.assertFalse(u.upgrade_password('cat'))
+		self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+		self.assertTrue(u.password_needs_rehash())
+		self.assertTrue(u.upgrade_password('cat'))
+		self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+		self.assertTrue(u.check_password('cat'))
+		self.app.config.update(PASSWORD_HASH_METHOD='pbkdf2:sha512:2000',
+							   PASSWORD_SALT_LENGTH=32)
+		u.set_password('cat')
+		self.assertLessEqual(len(u.password_hash), User.password_hash.type.length)
+
+	def test_token_cache(self):
+		Role.insert_roles()
+		u = User(username='susan', email='susan@example.com')
+		db.session.add(u)
+		token = u.get_token()
+		db.session.commit()
+		db.session.remove()
+		self.assertEqual(User.check_token(token).username, 'susan')
+		db.session.remove()
+		g.pop('token_principal')
+		hits = token_cache.hits
+		# The cached token is checked, the row is loaded as it is now.
+		db.session.execute(User.__table__.update().values(car_count=5))
+		db.session.commit()
+		user = User.check_token(token)
+		self.assertEqual(token_cache.hits, hits + 1)
+		self.assertEqual(user.username, 'susan')
+		self.assertEqual(user.car_count, 5)
+		self.assertTrue(user.can(Permission.USER))
+		user.revoke_token()
+		db.session.commit()
+		db.session.remove()
+		self.assertIsNone(User.check_token(token))
+
+	def test_token_cache_hit_without_queries(self):
+		Role.insert_roles()
+		u = User(username='susan', email='susan@example.com')
+		db.session.add(u)
+		token = u.get_token()
+		db.session.commit()
+		id = u.id
+		User.check_token(token)
+		g.pop('token_principal')
+		db.session.remove()
+		statements = []
+		def before_cursor_execute(conn, cursor, statement, *args):
+			statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+		try:
+			user = User.check_token(token)
+			self.assertEqual(user.id, id)
+			self.assertTrue(user.can(Permission.USER))
+			self.assertFalse(user.is_administrator())
+			self.assertEqual(statements, [])
+			# Other columns load the row.
+			self.assertEqual(user.username, 'susan')
+			self.assertEqual(len(statements), 1)
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class MailDispatcherCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(TestConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+
+	def tearDown(self):
+		dispatcher.shutdown()
+		self.app_context.pop()
+
+	def test_send_email(self):
+		with mail.record_messages() as outbox:
+			for i in range(5):
+				send_email('Hi {}'.format(i), sender='admin@ex.com',
+						   recipients=['user@example.com'],
+						   text_body='text', html_body='<p>html</p>')
+			dispatcher.flush()
+		self.assertEqual(sorted(msg.subject for msg in outbox),
+						 ['Hi {}'.format(i) for i in range(5)])
+		stats = dispatcher.stats()
+		self.assertEqual((stats['sent'], stats['queue_depth']), (5, 0))
+		self.assertLessEqual(stats['workers'], self.app.config['MAIL_WORKERS'])
+
+	def test_bad_messages(self):
+		def refuse(message, app):
+			if message.subject == 'Refused':
+				raise SMTPRecipientsRefused({'bad@example.com': (550, b'No such user')})
+
+		subjects = ['Hi', 'Refused', 'No recipients', 'Bye']
+		with mail.record_messages() as outbox, email_dispatched.connected_to(refuse):
+			for subject in subjects:
+				recipients = [] if subject == 'No recipients' else ['user@example.com']
+				send_email(subject, sender='admin@ex.com', recipients=recipients,
+						   text_body='text', html_body='<p>html</p>')
+			dispatcher.flush()
+		# Bad messages are given up at once, the others are sent.
+		self.assertLessEqual({'Hi', 'Bye'}, {msg.subject for msg in outbox})
+		stats = dispatcher.stats()
+		self.assertEqual((stats['sent'], stats['failed'], stats['retries']), (2, 2, 0))
+
+
+class SQLStatsCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(TestConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		Role.insert_roles()
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.client = self.app.test_client()
+		self.auth = {'Authorization': 'Basic ' +
+					 base64.b64encode(b'john:cat').decode('utf-8')}
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def test_headers_and_report(self):
+		response = self.client.post('/api/tokens', headers=self.auth)
+		count = int(response.headers['X-Query-Count'])
+		self.assertGreater(count, 0)
+		self.assertIn('sql;dur=', response.headers['Server-Timing'])
+		report = sql_stats.report()
+		self.assertEqual((report[0]['endpoint'], report[0]['max_queries']),
+						 ('api.get_token', count))
+
+	def test_query_budget(self):
+		self.app.config['SQL_QUERY_BUDGETS'] = {'api.get_token': 0}
+		with self.assertRaises(QueryBudgetExceeded):
+			self.client.post('/api/tokens', headers=self.auth)
+
+	def test_fingerprint(self):
+		self.assertEqual(fingerprint('SELECT a FROM t\n WHERE id IN (?, ?,?)'),
+						 'SELECT a FROM t WHERE id IN (?)')
+
+
+class MetricsCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(TestConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def test_render(self):
+		counter = Counter('test_total', 'Test.', ('code',))
+		counter.inc(code=200)
+		counter.inc(2, code='a"b')
+		self.assertEqual(counter.render().splitlines()[2:],
+						 ['test_total{code="200"} 1', 'test_total{code="a\\"b"} 2'])
+		histogram = Histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+		histogram.observe(0.5)
+		self.assertIn('test_seconds_bucket{le="0.1"} 0', histogram.render())
+		self.assertIn('test_seconds_bucket{le="+Inf"} 1', histogram.render())
+		self.assertIn('test_seconds_sum 0.5', histogram.render())
+
+	def test_endpoint(self):
+		client = self.app.test_client()
+		client.get('/no-such-page')
+		text = client.get('/metrics').data.decode('utf-8')
+		self.assertIn('http_requests_total{blueprint="none",endpoint="unknown",'
+					  'method="GET",status="404"}', text)
+		self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+		self.app.config['METRICS_TOKEN'] = 'secret'
+		self.assertEqual(client.get('/metrics').status_code, 401)
+		response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+		self.assertEqual(response.status_code, 200)
+
+	def test_pool_wait(self):
+		engine = create_engine('sqlite://', poolclass=MeasuredQueuePool)
+		count = lambda: metrics.db_checkout_wait._values.get((), [0, 0])[-2]
+		before = count()
+		engine.execute('SELECT 1')
+		self.assertEqual(count(), before + 1)
+
+
+class EngineProfileCase(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp(suffix='.db')
+		os.close(fd)
+
+	def tearDown(self):
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists(self.path + suffix):
+				os.remove(self.path + suffix)
+
+	def test_sqlite_concurrent(self):
+		class ProfileConfig(TestConfig):
+			SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.path
+			DATABASE_PROFILE = 'sqlite-concurrent'
+
+		app = create_app(ProfileConfig)
+		with app.app_context():
+			self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+			self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), 15000)
+			stats = pool_stats(db.engine)
+			self.assertEqual((stats['pool'], stats['size'], stats['checkedout']),
+							 ('MeasuredQueuePool', 5, 1))
+			db.session.remove()
+			db.engine.dispose()
+
+	def test_profile_options(self):
+		profile = Config.ENGINE_PROFILES['sqlite-concurrent']
+		self.assertEqual(engine_options('sqlite://', profile), {})
+		self.assertEqual(engine_options('postgresql://localhost/carrent',
+			Config.ENGINE_PROFILES['postgres-pooled'])['poolclass'], MeasuredQueuePool)
+
+		class UnknownConfig(TestConfig):
+			DATABASE_PROFILE = 'no-such-profile'
+
+		self.assertRaises(RuntimeError, create_app, UnknownConfig)
+
+
+class ReplicaCase(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		primary = os.path.join(self.dir, 'primary.db')
+		self.replica = os.path.join(self.dir, 'replica.db')
+
+		class ReplicaConfig(TestConfig):
+			SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+			DATABASE_REPLICA_URLS = ['sqlite:///' + self.replica]
+
+		self.app = create_app(ReplicaConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		Role.insert_roles()
+		Language.insert_values()
+		admin = User(username='admin', email=self.app.config['ADMINS'][0],
+					 language_id=reference.language_by_code('en').id)
+		db.session.add(admin)
+		db.session.commit()
+		self.headers = {'Authorization': 'Bearer ' + admin.get_token()}
+		self.admin_id = admin.id
+		db.session.commit()
+		# The replica is a copy of the primary without the new car.
+		shutil.copy(primary, self.replica)
+		db.session.add(Car(year='2000'))
+		db.session.commit()
+		db.session.remove()
+
+	def tearDown(self):
+		db.session.remove()
+		for engine in (db.get_engine(), db.get_engine(bind='replica1')):
+			engine.dispose()
+		self.app_context.pop()
+		shutil.rmtree(self.dir)
+
+	def test_routes(self):
+		with self.app.test_request_context():
+			self.assertEqual(replica_routing.route('api.get_cars'), 'replica')
+			self.assertEqual(replica_routing.route('admin.cars'), 'replica')
+			self.assertEqual(replica_routing.route('admin.user'), 'primary')
+			self.assertEqual(replica_routing.route(None), 'primary')
+
+	def test_read_your_writes(self):
+		client = self.app.test_client()
+		cars = lambda: client.get('/api/cars', headers=self.headers).get_json()['items']
+		self.assertEqual(cars(), [])
+		response = client.put('/api/users/{}'.format(self.admin_id),
+							  json={'username': 'root'}, headers=self.headers)
+		self.assertEqual(response.status_code, 200)
+		# The user is pinned to the primary on the server.
+		self.assertNotIn('Set-Cookie', response.headers)
+		self.assertEqual(len(cars()), 1)
+		self.assertEqual(len(self.app.test_client().get(
+			'/api/cars', headers=self.headers).get_json()['items']), 1)
+		self.assertEqual(User.query.get(self.admin_id).username, 'root')
+
+
+class RateLimitCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(TestConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		self.client = self.app.test_client()
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def test_token_bucket(self):
+		backend = MemoryBackend(self.app)
+		policy = Policy('test', '2/hour')
+		self.assertEqual([backend.take('a', policy.rate, policy.burst)[0]
+						  for i in range(3)], [True, True, False])
+		self.assertTrue(backend.take('b', policy.rate, policy.burst)[0])
+		self.assertEqual(rate_limiter.policy('api.get_token').name, 'api.get_token')
+		self.assertEqual(rate_limiter.policy('api.get_cars').key, 'token')
+		self.assertIsNone(rate_limiter.policy('main.index'))
+
+	def test_api_limit(self):
+		auth = {'Authorization': 'Basic ' + base64.b64encode(b'nobody:password').decode()}
+		for i in range(10):
+			self.assertEqual(self.client.post('/api/tokens', headers=auth).status_code, 401)
+		response = self.client.post('/api/tokens', headers=auth)
+		self.assertEqual(response.status_code, 429)
+		self.assertEqual(response.get_json()['error'], 'Too Many Requests')
+		self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+		# Other clients have their own buckets.
+		response = self.client.post('/api/tokens', headers=auth,
+									environ_base={'REMOTE_ADDR': '10.0.0.2'})
+		self.assertEqual(response.status_code, 401)
+		self.assertIn('rate_limited_total{policy="api.get_token"}', metrics.render())
+
+	def test_proxy_clients(self):
+		class ProxyConfig(TestConfig):
+			PROXY_FIX_X_FOR = 1
+			RATELIMIT_POLICIES = {'auth.login': {'limit': '1/hour'}}
+
+		app = create_app(ProxyConfig)
+		with app.app_context():
+			db.create_all()
+			client = app.test_client()
+			codes = [client.get('/auth/login', headers={'X-Forwarded-For': addr}).status_code
+					 for addr in ('10.0.0.1', '10.0.0.2', '10.0.0.1')]
+			db.drop_all()
+		self.assertEqual(codes, [200, 200, 429])
+
+	def test_token_key(self):
+		class TokenConfig(TestConfig):
+			RATELIMIT_POLICIES = {'api': {'limit': '2/hour', 'key': 'token'}}
+
+		app = create_app(TokenConfig)
+		with app.app_context():
+			db.create_all()
+			Role.insert_roles()
+			Language.insert_values()
+			user = User(username='susan', email='susan@example.com',
+						language_id=reference.language_by_code('en').id)
+			db.session.add(user)
+			token = user.get_token()
+			db.session.commit()
+			client = app.test_client()
+			get = lambda token: client.get('/api/cars', headers={
+				'Authorization': 'Bearer ' + token}).status_code
+			# Random tokens share the bucket of the address.
+			codes = [get(token) for token in ('a', 'b', 'c')]
+			self.assertEqual(codes, [401, 401, 429])
+			self.assertEqual(get(token), 200)
+			db.session.remove()
+			db.drop_all()
+
+	def test_page_limit(self):
+		for i in range(3):
+			response = self.client.post('/auth/reset_password_request', data={},
+										headers={'Accept': 'text/html'})
+			self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.client.get('/auth/reset_password_request').status_code, 200)
+		response = self.client.post('/auth/reset_password_request', data={},
+									headers={'Accept': 'text/html'})
+		self.assertEqual(response.status_code, 429)
+		self.assertIn(b'Too Many Requests', response.data)
+		self.assertIn('Retry-After', response.headers)
+
+
+class BenchCase(unittest.TestCase):
+	def test_percentile(self):
+		values = [1.0, 2.0, 3.0, 4.0, 5.0]
+		self.assertEqual(percentile(values, 50), 3.0)
+		self.assertEqual(percentile(values, 90), 4.6)
+		self.assertEqual(percentile([], 50), 0.0)
+
+	def test_load_test(self):
+		app = create_app(TestConfig)
+		with app.app_context():
+			db.create_all()
+		server = PooledWSGIServer('127.0.0.1', 0, app, threads=2)
+		thread = threading.Thread(target=server.serve_forever, daemon=True)
+		thread.start()
+		try:
+			result = load_test('http://127.0.0.1:{}'.format(server.server_port),
+							   ['/metrics'], {}, concurrency=4, seconds=0.3)
+		finally:
+			server.shutdown()
+		self.assertGreater(result['requests'], 0)
+		self.assertEqual(result['errors'], 0)
+
+	def test_bench_database(self):
+		app = create_app(TestConfig)
+		with app.app_context(), redirect_stdout(io.StringIO()):
+			self.assertFalse(bench_database_ready(5))
+			seed_database(5, 'password')
+			self.assertTrue(bench_database_ready(5))
+			self.assertFalse(bench_database_ready(10))
+			# Models changed after seeding.
+			db.session.execute("UPDATE bench_meta SET value = 'old' WHERE key = 'schema'")
+			self.assertFalse(bench_database_ready(5))
+			seed_database(5, 'password')
+			self.assertTrue(bench_database_ready(5))
+			self.assertEqual(User.query.count(), 5)
+			db.session.remove()
+
+	def test_compare_results(self):
+		result = lambda p50, queries: {'p50': p50, 'p90': p50, 'queries': queries}
+		baseline = {'scales': {'1000': {'a': result(10.0, 2), 'b': result(10.0, 2)}}}
+		current = {'scales': {'1000': {'a': result(11.0, 2), 'b': result(13.0, 3)},
+							  '100000': {'a': result(50.0, 2)}}}
+		regressions = [row[1:3] for row in compare_results(baseline, current, 0.2)
+					   if row[-1]]
+		self.assertEqual(regressions, [('b', 'p50'), ('b', 'p90'), ('b', 'queries')])
+
+
+class CarModelCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(TestConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		Role.insert_roles()
+		Language.insert_values()
+		# Load the reference data as the first request does.
+		reference.languages()
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def count_queries(self, func):
+		statements = []
+		def before_cursor_execute(conn, cursor, statement, *args):
+			statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+		try:
+			func()
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+		return len(statements)
+
+	def add_cars(self, count):
+		en = Language.query.filter_by(code='en').first()
+		ru = Language.query.filter_by(code='ru').first()
+		for i in range(count):
+			car = Car(year='2000')
+			car.set_name(en, 'Car {}'.format(i))
+			if i % 2:
+				car.set_name(ru, 'Машина {}'.format(i))
+			db.session.add(car)
+		db.session.commit()
+
+	def test_get_name_fallback(self):
+		self.add_cars(2)
+		cars = Car.query.order_by(Car.id).all()
+		self.assertEqual(cars[0].get_name('ru', False), 'Car 0')
+		self.assertEqual(cars[1].get_name('ru', False), 'Машина 1')
+		self.assertEqual(cars[1].get_name('ru'), 'Машина 1|2000')
+
+	def test_fragment_cache(self):
+		self.add_cars(3)
+		viewer = User(username='viewer', email='viewer@example.com',
+					  language_id=reference.language_by_code('ru').id)
+		db.session.add(viewer)
+		db.session.commit()
+		rows = lambda: fragment_cache.rows('admin/_car.html',
+										   Car.query.order_by(Car.id).all())
+		with self.app.test_request_context():
+			login_user(viewer)
+			first = rows()
+			self.assertIn('Машина 1', first[1])
+			self.assertEqual(self.count_queries(rows), 1)
+			self.assertEqual(rows(), first)
+			CarLanguage.query.get((2, reference.language_by_code('ru').id)).name = 'Новая'
+			db.session.commit()
+			self.assertEqual(len(fragment_cache.backend), 2)
+			second = rows()
+			self.assertIn('Новая', second[1])
+			self.assertEqual((second[0], second[2]), (first[0], first[2]))
+			# A failing backend doesn't fail pages or commits.
+			self.app.extensions['fragment_cache'] = BrokenBackend()
+			self.assertEqual(rows(), second)
+			Car.query.get(1).year = '2001'
+			db.session.commit()
+
+	def test_load_names_in_one_query(self):
+		self.add_cars(20)
+		cars = Car.query.all()
+		self.assertEqual(self.count_queries(
+			lambda: Car.load_names(cars, 'ru')), 1)
+		self.assertEqual(self.count_queries(
+			lambda: [car.get_name('ru') for car in cars]), 0)
+
+	def test_collection_queries_do_not_grow_with_page_size(self):
+		self.add_cars(20)
+		def page(per_page):
+			with self.app.test_request_context():
+				data = Car.to_collection_dict(Car.query, 1, per_page,
+					'api.get_car', id=1, lang_code='ru')
+				self.assertEqual(len(data['items']), per_page)
+			db.session.expire_all()
+		self.assertEqual(self.count_queries(lambda: page(5)),
+						 self.count_queries(lambda: page(20)))
+
+	def test_sparse_fields(self):
+		self.add_cars(3)
+		fields = Car.parse_fields('year, name')
+		self.assertEqual(fields, {'id', 'year', 'name'})
+		self.assertIsNone(Car.parse_fields(''))
+		with self.assertRaises(ValueError):
+			Car.parse_fields('year,password_hash')
+		with self.assertRaises(ValueError):
+			User.parse_fields('username,email')
+		def page(fields):
+			with self.app.test_request_context():
+				data = Car.to_collection_dict(Car.query, 1, 3, 'api.get_car',
+					fields=fields, id=1, lang_code='ru')
+			db.session.expire_all()
+			return data
+		data = page(fields)
+		self.assertEqual(data['items'][1], {'id': 2, 'year': '2000', 'name': 'Машина 1'})
+		self.assertIn('fields=id%2Cname%2Cyear', data['_links']['self'])
+		# Names aren't loaded when they aren't requested.
+		self.assertEqual(self.count_queries(lambda: page({'id', 'year'})),
+						 self.count_queries(lambda: page(fields)) - 1)
+
+	def test_export(self):
+		self.add_cars(3)
+		u = User(username='john', email='john@example.com')
+		u.cars.append(Car.query.get(2))
+		db.session.add(u)
+		db.session.commit()
+		lines = ''.join(export('cars', lang_code='ru', batch_size=2)).splitlines()
+		self.assertEqual(len(lines), 3)
+		car = json.loads(lines[0])
+		self.assertEqual((car['name'], car['default_name']), ('Car 0', 'Car 0'))
+		self.assertEqual(json.loads(lines[1])['name'], 'Машина 1')
+		self.assertEqual(''.join(export('user_cars', 'csv')).splitlines(),
+						 ['user_id,car_id', '1,2'])
+		self.assertIn('"username": "john"', ''.join(export('users')))
+		with self.assertRaises(ValueError):
+			export('tokens')
+
+	def test_import_cars(self):
+		self.add_cars(2)
+		rows = 'year,en,ru\n2001,Audi,Ауди\nnew,Bad,\n2002,,Только\n2003,BMW,\n'
+		with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+			self.assertEqual(import_cars(io.StringIO(rows), 'csv', batch_size=2), (2, 2))
+			rows = '{"id": 1, "year": 1999, "ru": "Машина"}\n{"year": 2004, "de": "Auto"}\n'
+			self.assertEqual(import_cars(io.StringIO(rows), 'ndjson'), (1, 1))
+		self.assertEqual(Car.query.count(), 4)
+		self.assertEqual(Car.query.get(3).get_name('ru', False), 'Ауди')
+		self.assertEqual(Car.query.get(4).year, '2003')
+		car = Car.query.get(1)
+		self.assertEqual((car.year, car.version, car.get_name('ru', False)),
+						 ('1999', 2, 'Машина'))
+		self.assertEqual(sorted(car.id for car in search_cars('машина')), [1, 2])
+
+	def test_search_by_name(self):
+		self.add_cars(12)
+		u = User(username='john', email='john@example.com')
+		db.session.add(u)
+		u.cars.append(Car.query.get(2))
+		db.session.commit()
+		self.assertEqual([car.id for car in Car.search_by_name('Car 1')],
+						 [2, 11, 12])
+		self.assertEqual([car.id for car in Car.search_by_name('Car 1', u)],
+						 [11, 12])
+		self.assertEqual([car.id for car in Car.search_by_name('Машина 1')],
+						 [2, 12])
+		self.assertEqual(len(Car.search_by_name('', limit=5)), 5)
+
+	def test_catalog(self):
+		self.add_cars(6)
+		for car in Car.query.filter(Car.id > 3):
+			car.year = '2010'
+		Car.query.get(6).timestamp = datetime(2019, 1, 1)
+		db.session.commit()
+		ids = lambda query: sorted(car.id for car in query)
+		self.assertEqual(ids(Car.catalog(year_to='2005')), [1, 2, 3])
+		self.assertEqual(ids(Car.catalog(year_from='2005', name='Car')), [4, 5, 6])
+		self.assertEqual(ids(Car.catalog(name='Машина', lang_code='ru')), [2, 4, 6])
+		self.assertEqual(ids(Car.catalog(until=datetime(2020, 1, 1))), [6])
+		self.assertEqual(ids(Car.catalog(year_from='2005',
+										 since=datetime(2020, 1, 1))), [4, 5])
+
+	def test_catalog_window_plan(self):
+		def plan(query):
+			sql = query.statement.compile(dialect=db.engine.dialect,
+										  compile_kwargs={'literal_binds': True})
+			return [row[-1] for row in db.session.execute(
+				'EXPLAIN QUERY PLAN {}'.format(sql))]
+		window = {'since': datetime(2019, 1, 1), 'until': datetime(2020, 1, 1)}
+		for filters in ({'since': window['since']}, {'until': window['until']},
+						window, dict(window, year_from='2005')):
+			steps = plan(Car.catalog(**filters))
+			self.assertEqual(len(steps), 1, steps)
+			self.assertIn('USING INDEX ix_car_timestamp', steps[0])
+
+	def test_search_cars(self):
+		self.add_cars(12)
+		ids = lambda cars: [car.id for car in cars]
+		self.assertEqual(sorted(ids(search_cars('car 1'))), [2, 11, 12])
+		self.assertEqual(sorted(ids(search_cars('МАШИНА'))), [2, 4, 6, 8, 10, 12])
+		self.assertEqual(len(search_cars('car', limit=5)), 5)
+		self.assertEqual(search_cars('" OR *'), [])
+		# The index follows changed, added and deleted names.
+		Car.query.get(3).names[0].name = 'Audi'
+		Car.query.get(3).set_name(reference.language_by_code('ru'), 'Ауди')
+		Car.query.get(4).names[0].name = 'Audi A4'
+		db.session.delete(Car.query.get(2))
+		db.session.commit()
+		self.assertEqual(ids(search_cars('audi')), [3, 4])
+		self.assertEqual(ids(search_cars('audi a4')), [4])
+		self.assertEqual(ids(search_cars('ауди')), [3])
+		self.assertEqual(sorted(ids(search_cars('car 1'))), [11, 12])
+		rebuild_index()
+		self.assertEqual(ids(search_cars('audi')), [3, 4])
+
+	def test_postgresql_search_statement(self):
+		statement = _postgresql_query('car', 10).statement \
+			.compile(dialect=postgresql_psycopg2.dialect())
+		# psycopg2 formats parameters with %, the operator must survive it.
+		sql = str(statement) % {name: 'x' for name in statement.params}
+		self.assertIn('car_language.name % x', sql)
+
+	def test_cursor_pagination(self):
+		self.add_cars(7)
+		ids = []
+		cursor = ''
+		with self.app.test_request_context():
+			while cursor is not None:
+				data = Car.to_collection_dict(Car.query, 1, 3, 'api.get_car',
+					cursor=cursor, id=1)
+				ids += [item['id'] for item in data['items']]
+				cursor = data['meta']['next_cursor']
+			self.assertNotIn('total_items', data['meta'])
+			with self.assertRaises(ValueError):
+				Car.to_collection_dict(Car.query, 1, 3, 'api.get_car',
+					cursor='not a cursor', id=1)
+		self.assertEqual(ids, list(range(1, 8)))
+
+	def test_fake_data(self):
+		fake.users(20, batch_size=7, seed=1)
+		fake.cars(30, batch_size=8, seed=1)
+		self.assertEqual(User.query.count(), 20)
+		self.assertEqual(Car.query.count(), 30)
+		self.assertEqual(db.session.query(db.func.sum(User.car_count)).scalar(), 30)
+		self.assertTrue(User.query.first().check_password('password'))
+		self.assertTrue(Car.query.first().get_name('ru'))
+
+	def test_bulk_add_remove_cars(self):
+		self.add_cars(4)
+		u = User(username='john', email='john@example.com')
+		db.session.add(u)
+		u.cars.append(Car.query.get(1))
+		db.session.commit()
+		self.assertEqual(sorted(u.add_cars([1, 2, 3, 3])), [2, 3])
+		db.session.commit()
+		self.assertEqual(u.car_count, 3)
+		self.assertEqual(Car.query.get(2).users_count, 1)
+		self.assertEqual(u.remove_cars([3, 4]), [3])
+		db.session.commit()
+		self.assertEqual(u.car_count, 2)
+		self.assertEqual(sorted(car.id for car in u.cars), [1, 2])
+		self.assertEqual(Car.query.get(3).users_count, 0)
+
+	def test_user_cars_api(self):
+		self.add_cars(3)
+		admin = User(username='admin', email=self.app.config['ADMINS'][0],
+					 language_id=reference.language_by_code('en').id)
+		db.session.add(admin)
+		headers = {'Authorization': 'Bearer ' + admin.get_token()}
+		db.session.commit()
+		client = self.app.test_client()
+		url = '/api/users/{}/cars'.format(admin.id)
+		post = lambda ids: client.post(url, json={'car_ids': ids}, headers=headers)
+		self.assertEqual(post([1, True]).status_code, 400)
+		self.assertEqual(post([1, 2]).get_json(), {'added': [1, 2], 'car_count': 2})
+		self.assertEqual(post([2, 3]).get_json(), {'added': [3], 'car_count': 3})
+		response = client.delete(url, json={'car_ids': [1]}, headers=headers)
+		self.assertEqual(response.get_json(), {'removed': [1], 'car_count': 2})
+		dispatcher.flush()
+		self.assertEqual([car.users_count for car in Car.query.order_by(Car.id)],
+						 [0, 1, 1])
+		# per_page is at least 1, with a cursor too.
+		response = client.get(url + '?cursor=&per_page=0', headers=headers)
+		self.assertEqual(len(response.get_json()['items']), 1)
+
+	def test_change_feed(self):
+		self.add_cars(3)
+		u = User(username='john', email='john@example.com',
+				 language_id=reference.language_by_code('en').id)
+		db.session.add(u)
+		u.cars.append(Car.query.get(1))
+		db.session.commit()
+		with self.app.test_request_context():
+			feed = Change.to_feed_dict(0, 100)
+		since = feed['meta']['next_since']
+		self.assertEqual(sorted((item['entity'], item.get('id', item.get('car_id')))
+								for item in feed['items']),
+						 [('car', 1), ('car', 2), ('car', 3), ('user', 1), ('user_car', 1)])
+		u.add_cars([2])
+		u.remove_cars([1])
+		db.session.delete(Car.query.get(3))
+		db.session.commit()
+		with self.app.test_request_context():
+			feed = Change.to_feed_dict(since, 2)
+			self.assertTrue(feed['meta']['has_more'])
+			feed['items'] += Change.to_feed_dict(feed['meta']['next_since'], 100)['items']
+		changes = {(item['entity'], item.get('id', item.get('car_id'))): item
+				   for item in feed['items']}
+		self.assertEqual(len(changes), len(feed['items']))
+		self.assertEqual(set(changes), {('user', 1), ('car', 1), ('car', 2), ('car', 3),
+										('user_car', 1), ('user_car', 2)})
+		self.assertTrue(changes[('car', 3)]['deleted'])
+		self.assertTrue(changes[('user_car', 1)]['deleted'])
+		self.assertFalse(changes[('user_car', 2)]['deleted'])
+		self.assertEqual(changes[('user', 1)]['data']['car_count'], 1)
+		self.assertIsNotNone(Car.query.get(2).updated_at)
+		# Young changes can be preceded by uncommitted ones.
+		with self.app.test_request_context():
+			feed = Change.to_feed_dict(0, 100, lag=60)
+		self.assertEqual((feed['items'], feed['meta']['next_since']), ([], 0))
+
+	def test_versions(self):
+		self.add_cars(2)
+		u = User(username='john', email='john@example.com')
+		db.session.add(u)
+		db.session.commit()
+		c1, c2 = Car.query.order_by(Car.id).all()
+		self.assertEqual((u.version, c1.version), (1, 1))
+		cars_version = u.get_cars_version()
+		u.cars.append(c1)
+		db.session.commit()
+		self.assertEqual((u.version, c1.version, c2.version), (2, 2, 1))
+		self.assertNotEqual(u.get_cars_version(), cars_version)
+		cars_version = u.get_cars_version()
+		c1.names.first().name = 'New name'
+		db.session.commit()
+		self.assertEqual((u.version, c1.version), (2, 3))
+		self.assertNotEqual(u.get_cars_version(), cars_version)
+		# Tokens and passwords are not versioned and not in the feed.
+		last_change = lambda: db.session.query(db.func.max(Change.id)).scalar()
+		change = last_change()
+		u.get_token()
+		db.session.commit()
+		u.revoke_token()
+		u.set_password('cat')
+		db.session.commit()
+		self.assertEqual((u.version, last_change()), (2, change))
+		u.username = 'johnny'
+		db.session.commit()
+		self.assertEqual(u.version, 3)
+		self.assertGreater(last_change(), change)
+
+	def test_reference_data(self):
+		self.assertEqual(self.count_queries(
+			lambda: (reference.language_by_code('ru'), reference.default_role())), 0)
+		u = User(username='john', email='john@example.com')
+		admin = User(username='admin', email=self.app.config['ADMINS'][0])
+		self.assertFalse(u.is_administrator())
+		self.assertTrue(admin.is_administrator())
+		db.session.add(Language(name='Deutsch', code='de'))
+		db.session.commit()
+		self.assertEqual(reference.language_by_code('de').name, 'Deutsch')
+		self.assertEqual(len(Language.choices()), 3)
+		# Misses don't reload the rows within the interval.
+		self.assertEqual(self.count_queries(
+			lambda: [reference.language_by_code('xx') for i in range(3)]), 0)
+		# Rows changed by another process are seen after the interval.
+		db.session.execute(Role.__table__.update()
+			.where(Role.name == 'User').values(permissions=0))
+		db.session.commit()
+		self.assertTrue(u.can(Permission.USER))
+		self.app.config['REFERENCE_RELOAD_INTERVAL'] = 0
+		self.assertFalse(u.can(Permission.USER))
+
+	def test_counters(self):
+		self.add_cars(3)
+		u1 = User(username='john', email='john@example.com')
+		u2 = User(username='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		c1, c2, c3 = Car.query.order_by(Car.id).all()
+		u1.cars.append(c1)
+		u1.cars.append(c2)
+		c1.users.append(u2)
+		db.session.commit()
+		self.assertEqual((u1.car_count, u2.car_count), (2, 1))
+		self.assertEqual((c1.users_count, c2.users_count, c3.users_count),
+						 (2, 1, 0))
+		u1.cars.remove(c1)
+		db.session.commit()
+		self.assertEqual((u1.car_count, c1.users_count), (1, 1))
+		db.session.delete(c2)
+		db.session.delete(u2)
+		db.session.commit()
+		self.assertEqual((u1.car_count, c1.users_count), (0, 0))
+		User.query.update({'car_count': 5})
+		User.update_car_counts()
+		Car.update_users_counts()
+		db.session.commit()
+		self.assertEqual(u1.car_count, 0)
+		# Counters are updated in SQL, a concurrent change is not lost.
+		db.session.execute(User.__table__.update().values(car_count=5))
+		u1.cars.append(c3)
+		db.session.commit()
+		self.assertEqual((u1.car_count, c3.users_count), (6, 1))
 
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
\ No newline at end of file